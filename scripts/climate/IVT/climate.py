@@ -42,42 +42,72 @@ run_dir = "/global/cscratch1/sd/mwehner/machine_learning_climate_data/All-Hist/C
 allfiles = sorted(os.listdir(run_dir))
 # filenames = allfiles[7000:]
 filenames = allfiles[7170:]
-assert past_depth >= future_depth, 'assuming past_depth >= future_depth'
-p = past_depth - 1 
-halo = int((p - p%8) / 8) + 1
-index = rank % 8
-file = int((rank - index) / 8)
-myfiles = filenames[file : (file+1) + 2*halo]
-myfield = np.vstack([Dataset(run_dir+ '/'+f, 'r')[observable][:] for f in myfiles]).astype(np.float32)
-pmargin = 8*halo - past_depth + index
-fmargin = 8*halo - future_depth + (7-index)
-myfield = myfield[pmargin: -fmargin]
+# (lat, lon) tiles to split each time step into, to run on more processes than time steps
+tiles = (1, 1)
+# wrap the longitude halos periodically, which gives the edge longitudes states instead of
+# the NAN state; results then differ from those of earlier (open boundary) runs
+wrap_longitude = False
+n_steps = size // (tiles[0]*tiles[1])
+# one 3-hourly time step per process (or group of tiles), starting at the first step with a full past lightcone
+driver = DiscoDriver(TimeAxis(filenames, 8), past_depth, future_depth, comm, stop=past_depth+n_steps,
+                     tiles=tiles, lattice_shape=(768, 1152), propagation_speed=c, periodic=(False, wrap_longitude))
+# hybrid MPI + threads: run_haswell.sl places one process per socket, which threads
+# over the socket's cores and sums the joint distribution within its node first
+n_threads = driver.setup_hybrid()
 
-    
-recon = DiscoReconstructor(past_depth, future_depth, c)
-recon.extract(myfield)
-del myfield
-comm.Barrier()
-d4p.daalinit()
-recon.kmeans_lightcones(past_params, future_params, past_decay=decay, future_decay=decay)
-recon.reconstruct_morphs()
-comm.Barrier() 
-comm.Allreduce(recon.local_joint_dist, recon.global_joint_dist, op=MPI.SUM ) 
-recon.reconstruct_states(chi_squared)
+save_dir = '/global/project/projectdirs/ProjectDisCo/Adam/climate/{}/result-{}/'.format(observable, result)
+# resume a resubmitted job from the last stage checkpointed by a failed or timed-out one
+checkpoint_dir = save_dir+'checkpoint/'
+d4p.daalinit(n_threads)
+recon = DiscoReconstructor(past_depth, future_depth, c, n_workers=n_threads, telemetry=True)
+completed = recon.restore_checkpoint(checkpoint_dir, comm, n_clusters=(past_K, future_K))
+if not stage_completed(completed, 'cluster'):
+    # the driver wraps any periodic halos into each window, tiled or not, so the
+    # windows are extracted with open boundaries
+    myfield = driver.load_netcdf(run_dir, [observable])[observable]
+    recon.extract(myfield, boundary_condition='open')
+    del myfield
+    recon.kmeans_lightcones(past_params, future_params, past_decay=decay, future_decay=decay)
+    recon.checkpoint(checkpoint_dir, 'cluster', comm)
+if not stage_completed(completed, 'morphs'):
+    recon.reconstruct_morphs()
+    # start the joint distribution reduction and prepare the filter while it is in flight;
+    # the checkpoint waits for the reduction to complete
+    recon.reduce_morphs(comm, blocking=False, node_comms=driver.node_comms)
+    recon.prepare_filter()
+    recon.checkpoint(checkpoint_dir, 'morphs', comm)
+if not stage_completed(completed, 'states'):
+    # consensus of 32 random orderings of the pasts, clustered in the process's threads
+    recon.reconstruct_states_ensemble(chi_squared, n_workers=n_threads)
+    recon.checkpoint(checkpoint_dir, 'states', comm)
 recon.causal_filter()
+if rank == 0 and recon.reduce_times is not None:
+    reduce_times = recon.reduce_times
+    # the reduction was only hidden behind the filter preparation if it completed during it
+    print('Joint distribution reduction: {} during {:.3f} s of filter preparation, then {:.3f} s waited'.format(
+            'completed' if reduce_times.completed else 'still in flight', reduce_times.in_flight, reduce_times.waited), flush=True)
 
-save_dir = '/global/project/projectdirs/ProjectDisCo/Adam/climate/{}/result-{}/fields/'.format(observable, result)
-workfile = myfiles[halo]
-save_file = workfile[:-8]+'{:02}'.format(3*index) # add hour of the day for the given time-step
-np.save(save_dir+save_file, recon.state_field)
+# all processes write their time steps into one netCDF file, with the source time and lat/lon coordinates
+source = Dataset(run_dir+ '/'+filenames[0], 'r')
+times = np.concatenate([Dataset(run_dir+ '/'+f, 'r')['time'][start:stop] for f, start, stop in driver.owned_segments()])
+time_attrs = {key: source['time'].getncattr(key) for key in ('units', 'calendar') if key in source['time'].ncattrs()}
+driver.write_states(save_dir+'states.nc', recon.state_field,
+                    coords={'time': times, 'lat': source['lat'][:], 'lon': source['lon'][:]},
+                    coord_attrs={'time': time_attrs})
+
+# wall time, CPU time and memory growth of every stage, over all processes
+summary = recon.telemetry_report(comm, path=save_dir+'telemetry.txt')
+if rank == 0:
+    print(summary, flush=True)
 
 run_details = "past_depth: {} \nfuture_depth: {} \nc :{} \
-               \npast_K: {} \nfuture_K: {} \nlc decay: {} ".format(past_depth, 
+               \npast_K: {} \nfuture_K: {} \nlc decay: {} \nwrap longitude: {} ".format(past_depth, 
                                                                     future_depth, 
                                                                     c, 
                                                                     past_K, 
                                                                     future_K, 
-                                                                    decay)
+                                                                    decay, 
+                                                                    wrap_longitude)
 
 if rank == 0:
     full_end = time.time()
@@ -45,30 +45,12 @@ d4p.daalinit()
 run_dir = "/global/project/projectdirs/dasrepo/gmd/input/ALLHIST/run1"
 allfiles = sorted(os.listdir(run_dir))
 filenames = allfiles[7522:]
-assert past_depth >= future_depth, 'assuming past_depth >= future_depth'
-p = past_depth - 1 
-halo = int((p - p%8) / 8) + 1
-index = rank % 8
-file = int((rank - index) / 8)
-myfiles = filenames[file : (file+1) + 2*halo]
-
-# Load TMQ data for one time-step per process
-myfield = np.vstack([Dataset(run_dir+ '/'+f, 'r')['TMQ'][:] for f in myfiles])
-pmargin = 8*halo - past_depth + index
-fmargin = 8*halo - future_depth + (7-index)
-TMQfield = myfield[pmargin: -fmargin]
-
-# Load U850 data for one time-step per process
-myfield = np.vstack([Dataset(run_dir+ '/'+f, 'r')['U850'][:] for f in myfiles])
-pmargin = 8*halo - past_depth + index
-fmargin = 8*halo - future_depth + (7-index)
-Ufield = myfield[pmargin: -fmargin]
-
-# Load V850 data for one time-step per process
-myfield = np.vstack([Dataset(run_dir+ '/'+f, 'r')['V850'][:] for f in myfiles])
-pmargin = 8*halo - past_depth + index
-fmargin = 8*halo - future_depth + (7-index)
-Vfield = myfield[pmargin: -fmargin]
+# one 3-hourly time step per process, starting at the first step with a full past lightcone
+driver = DiscoDriver(TimeAxis(filenames, 8), past_depth, future_depth, comm, stop=past_depth+size)
+
+# Load TMQ, U850 and V850 data for my time-step, opening each file once
+fields = driver.load_netcdf(run_dir, ['TMQ', 'U850', 'V850'])
+TMQfield, Ufield, Vfield = fields.pop('TMQ'), fields.pop('U850'), fields.pop('V850')
 
 # extract from TMQ first    
 reconQ = DiscoReconstructor(past_depth, future_depth, c)
@@ -97,18 +79,30 @@ reconQ.flcs = np.concatenate((flcs_1, flcs_2), axis=1)
 
 plc_decays = np.concatenate(( past_spacetime_decay(past_depth, c, decay), past_spacetime_decay(past_depth, c, decay) ))
 reconQ.plcs *= np.sqrt(plc_decays)
-comm.Barrier()
 reconQ.kmeans_lightcones(past_params, future_params, decay_type='none', past_decay=0, future_decay=0)
 reconQ.reconstruct_morphs()
-comm.Barrier() 
-comm.Allreduce(reconQ.local_joint_dist, reconQ.global_joint_dist, op=MPI.SUM ) 
-reconQ.reconstruct_states(chi_squared)
+# start the joint distribution reduction and prepare the filter while it is in flight;
+# reconstruct_states_ensemble() waits for the reduction to complete
+reconQ.reduce_morphs(comm, blocking=False)
+reconQ.prepare_filter()
+# consensus of 32 random orderings of the pasts; with a process per time step, each
+# clusters its orderings in a single thread
+reconQ.reconstruct_states_ensemble(chi_squared, n_workers=1)
 reconQ.causal_filter()
-
-save_dir = '/global/project/projectdirs/ProjectDisCo/Adam/climate/{}/result-{}/fields/'.format(observable, result)
-workfile = myfiles[halo]
-save_file = workfile[:-8]+'{:02}'.format(3*index) # add hour of the day for the given time-step
-np.save(save_dir+save_file, reconQ.state_field)
+if rank == 0:
+    reduce_times = reconQ.reduce_times
+    # the reduction was only hidden behind the filter preparation if it completed during it
+    print('Joint distribution reduction: {} during {:.3f} s of filter preparation, then {:.3f} s waited'.format(
+            'completed' if reduce_times.completed else 'still in flight', reduce_times.in_flight, reduce_times.waited), flush=True)
+
+# all processes write their time steps into one netCDF file, with the source time and lat/lon coordinates
+save_dir = '/global/project/projectdirs/ProjectDisCo/Adam/climate/{}/result-{}/'.format(observable, result)
+source = Dataset(run_dir+ '/'+filenames[0], 'r')
+times = np.concatenate([Dataset(run_dir+ '/'+f, 'r')['time'][start:stop] for f, start, stop in driver.owned_segments()])
+time_attrs = {key: source['time'].getncattr(key) for key in ('units', 'calendar') if key in source['time'].ncattrs()}
+driver.write_states(save_dir+'states.nc', reconQ.state_field,
+                    coords={'time': times, 'lat': source['lat'][:], 'lon': source['lon'][:]},
+                    coord_attrs={'time': time_attrs})
 
 run_details = "past_depth: {} \nfuture_depth: {} \nc :{} \
                \npast_K: {} \nfuture_K: {} \nlc decay: {} ".format(past_depth, 
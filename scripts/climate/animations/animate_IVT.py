@@ -12,6 +12,7 @@ module_path = os.path.abspath(os.path.join('/global/common/software/ProjectDisCo
 sys.path.append(module_path)
 
 from source.visuals import *
+from source.pdisco import TimeAxis
 
 start = time.time()
 
@@ -47,23 +48,34 @@ observable = 'IVT'
 result = '8'
 
 run_dir = "/global/cscratch1/sd/mwehner/machine_learning_climate_data/All-Hist/CAM5-1-0.25degree_All-Hist_est1_v3_run1/IVT/"
-obs_fields = []
-lcsdir = "/global/project/projectdirs/ProjectDisCo/Adam/climate/{}/result-{}/fields/".format(observable,result)
-lcsfiles = sorted(os.listdir(lcsdir))
-lcs_fields = []
+result_dir = "/global/project/projectdirs/ProjectDisCo/Adam/climate/{}/result-{}/".format(observable,result)
 
-for i,s in enumerate(lcsfiles):
-    s_field = np.load(lcsdir+s)
-    lcs_fields.append(s_field)
-    index = i%8
-    if index == 0:
-        obs_name = s[:-6]+'00000.nc'
-        obs_load = Dataset(run_dir+obs_name, 'r')[observable][:]
-    obs_field = obs_load[index]
-    obs_fields.append(obs_field)
-    
-state_field = np.vstack(lcs_fields)
-field = np.stack(obs_fields)
+if os.path.exists(result_dir+'states.nc'):
+    # state field and its first global time step, see DiscoDriver.write_states()
+    filenames = sorted(os.listdir(run_dir))[7170:] # same files as the segmentation run
+    states = Dataset(result_dir+'states.nc', 'r')
+    state_field = states['states'][:]
+    first = int(states.first_step)
+    segments = TimeAxis(filenames, 8).segments(first, first + len(state_field))
+    field = np.vstack([Dataset(run_dir+f, 'r')[observable][start:stop] for f, start, stop in segments])
+else:
+    # results from before states.nc were saved as one .npy file per process and
+    # time step, 8 time steps to a source file
+    lcsdir = result_dir+'fields/'
+    obs_fields = []
+    lcsfiles = sorted(os.listdir(lcsdir))
+    lcs_fields = []
+    for i,s in enumerate(lcsfiles):
+        s_field = np.load(lcsdir+s)
+        lcs_fields.append(s_field)
+        index = i%8
+        if index == 0:
+            obs_name = s[:-6]+'00000.nc'
+            obs_load = Dataset(run_dir+obs_name, 'r')[observable][:]
+        obs_field = obs_load[index]
+        obs_fields.append(obs_field)
+    state_field = np.vstack(lcs_fields)
+    field = np.stack(obs_fields)
 
 anim = comparison_animate(field, state_field, ticks=False, invert_y=False, field_cmap=plt.cm.gist_earth, state_cmap=plt.cm.Set3)
 
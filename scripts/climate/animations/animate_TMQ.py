@@ -12,6 +12,7 @@ module_path = os.path.abspath(os.path.join('/global/common/software/ProjectDisCo
 sys.path.append(module_path)
 
 from source.visuals import *
+from source.pdisco import TimeAxis
 
 start = time.time()
 
@@ -49,23 +50,34 @@ result = '9'
 # future_depth = 3
 
 run_dir = "/global/project/projectdirs/dasrepo/gmd/input/ALLHIST/run1/"
-obs_fields = []
-lcsdir = "/global/project/projectdirs/ProjectDisCo/Adam/climate/{}/result-{}/fields/".format(observable,result)
-lcsfiles = sorted(os.listdir(lcsdir))
-lcs_fields = []
-
-for i,s in enumerate(lcsfiles):
-    s_field = np.load(lcsdir+s)
-    lcs_fields.append(s_field)
-    index = i%8
-    if index == 0:
-        obs_name = s[:-6]+'00000.nc'
-        obs_load = Dataset(run_dir+obs_name, 'r')[observable][:]
-    obs_field = obs_load[index]
-    obs_fields.append(obs_field)
-    
-state_field = np.vstack(lcs_fields)
-field = np.stack(obs_fields)
+result_dir = "/global/project/projectdirs/ProjectDisCo/Adam/climate/{}/result-{}/".format(observable,result)
+
+if os.path.exists(result_dir+'states.nc'):
+    # state field and its first global time step, see DiscoDriver.write_states()
+    filenames = sorted(os.listdir(run_dir))[7522:] # same files as the segmentation run
+    states = Dataset(result_dir+'states.nc', 'r')
+    state_field = states['states'][:]
+    first = int(states.first_step)
+    segments = TimeAxis(filenames, 8).segments(first, first + len(state_field))
+    field = np.vstack([Dataset(run_dir+f, 'r')[observable][start:stop] for f, start, stop in segments])
+else:
+    # results from before states.nc were saved as one .npy file per process and
+    # time step, 8 time steps to a source file
+    lcsdir = result_dir+'fields/'
+    obs_fields = []
+    lcsfiles = sorted(os.listdir(lcsdir))
+    lcs_fields = []
+    for i,s in enumerate(lcsfiles):
+        s_field = np.load(lcsdir+s)
+        lcs_fields.append(s_field)
+        index = i%8
+        if index == 0:
+            obs_name = s[:-6]+'00000.nc'
+            obs_load = Dataset(run_dir+obs_name, 'r')[observable][:]
+        obs_field = obs_load[index]
+        obs_fields.append(obs_field)
+    state_field = np.vstack(lcs_fields)
+    field = np.stack(obs_fields)
 
 # anim = comparison_animate(field[past_depth:-future_depth], state_field[past_depth:-future_depth], ticks=False, invert_y=False, field_cmap=plt.cm.Blues, state_cmap=plt.cm.Set3)
 anim = comparison_animate(field, state_field, xtick_spacing=100, ytick_spacing=50, field_cmap=plt.cm.Blues, state_cmap=plt.cm.Set3)
@@ -4,12 +4,11 @@ modified: Nalini Kumar
 email: atrupe@ucdavis.edu
 brief: Test run on Jupiter grayscale data
 usage: python jupiter.py
-dependencies: python3, numpy, numba, mpi4py, daal4py
+dependencies: python3, numpy, numba, mpi4py, daal4py, netCDF4
 '''
 
 # OPT: import only parts of os and sys that we need?
 import time, os, sys
-from math import ceil
 
 #Parent directory which contains the disco repo
 module_path = os.path.abspath(os.path.join('/global/common/software/ProjectDisCo/'))
@@ -43,44 +42,53 @@ future_params = {'nClusters':K_future, 'maxIterations':200}
 p_i_params = {'nClusters':K_past, 'method':'plusPlusDense', 'distributed': True}
 f_i_params = {'nClusters':K_future, 'method':'plusPlusDense', 'distributed': True}
 
-# Load data with appropriate halos
-work = 1
-
-# Load data with appropriate halos
+# Load my slab of the data, one image per time step, with appropriate halos
 data_dir = '/global/project/projectdirs/ProjectDisCo/Jupiter/gs_arrays/'
 allfiles = sorted(os.listdir(data_dir))
-total = len(allfiles)
-n_procs = ceil((total - (p_depth+f_depth))/work) 
-last = n_procs - 1
-if rank == last:
-    myfiles = allfiles[rank*work : total]
-else:
-    myfiles = allfiles[rank*work : (rank+1)*work + (p_depth+f_depth)]
-myfield = np.stack([np.load(os.path.join(data_dir, f)) for f in myfiles])
-myfield = myfield[:, 400:-400, :2200].astype(np.float32)
+driver = DiscoDriver(TimeAxis(allfiles, 1), p_depth, f_depth, comm)
+# images are memory-mapped, so only the cropped region is read and sent to neighbouring ranks
+myfield = driver.load(lambda f, start, stop: np.load(os.path.join(data_dir, f), mmap_mode='r')[np.newaxis, 400:-400, :2200],
+                      dtype=np.float32)
 
 
 # Initialize DiscoReconstructor object with past and future lightcone depths
-recon = DiscoReconstructor(p_depth, f_depth, c)
+recon = DiscoReconstructor(p_depth, f_depth, c, telemetry=True)
 
 # Extract lightcones from my subset of files
 recon.extract(myfield, boundary_condition='periodic')
 del myfield
 
-comm.Barrier()
+# slabs differ by at most one time step; report the measured imbalance
+counts, imbalance = driver.load_imbalance(len(recon.plcs))
+if rank == 0:
+    print('Lightcones per process: {} to {}, load imbalance: {:.1%}'.format(counts.min(), counts.max(), imbalance), flush=True)
 
 d4p.daalinit()
 recon.kmeans_lightcones(past_params, future_params, decay_type=decay_type, past_decay=p_decay, future_decay=f_decay, past_init_params=p_i_params, future_init_params=f_i_params,)
 recon.reconstruct_morphs()
-comm.Barrier()
-comm.Allreduce(recon.local_joint_dist, recon.global_joint_dist, op=MPI.SUM ) 
-recon.reconstruct_states(chi_squared)
+# start the joint distribution reduction and prepare the filter while it is in flight;
+# the state reconstruction waits for the reduction to complete
+recon.reduce_morphs(comm, blocking=False)
+recon.prepare_filter()
+# consensus of 32 random orderings of the pasts; every core already runs a process
+recon.reconstruct_states_ensemble(chi_squared, n_workers=1)
 recon.causal_filter()
+if rank == 0:
+    reduce_times = recon.reduce_times
+    # the reduction was only hidden behind the filter preparation if it completed during it
+    print('Joint distribution reduction: {} during {:.3f} s of filter preparation, then {:.3f} s waited'.format(
+            'completed' if reduce_times.completed else 'still in flight', reduce_times.in_flight, reduce_times.waited), flush=True)
+
+save_dir = '/global/project/projectdirs/ProjectDisCo/Adam/jupiter/results/result-{}/'.format(result)
+# all processes write their time steps into one netCDF file
+driver.write_states(save_dir+'states.nc', recon.state_field, dims=('time', 'y', 'x'))
 
-save_dir = '/global/project/projectdirs/ProjectDisCo/Adam/jupiter/results/result-{}/fields/'.format(result)
-save_name = 'jup_states_{:03d}'.format(rank)
-np.save(save_dir+save_name, recon.state_field)
+# wall time, CPU time and memory growth of every stage, over all processes
+summary = recon.telemetry_report(comm, path=save_dir+'telemetry.txt')
+if rank == 0:
+    print(summary, flush=True)
 
+# wait for all processes so the time to solution covers the whole job
 comm.Barrier()
 
 if rank == 0:
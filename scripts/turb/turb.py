@@ -8,7 +8,6 @@ dependencies: python3, numpy, numba, mpi4py, daal4py
 
 # OPT: import only parts of os and sys that we need?
 import time, os, sys
-from math import ceil
 from netCDF4 import Dataset
 
 #Parent directory which contains the disco repo
@@ -46,49 +45,57 @@ future_params = {'nClusters':K_future, 'maxIterations':200}
 p_i_params = {'nClusters':K_past, 'method':'plusPlusDense', 'distributed': True}
 f_i_params = {'nClusters':K_future, 'method':'plusPlusDense', 'distributed': True}
 
-# Load data with appropriate halos
-work = 2
-
+# Load my slab of the data, with appropriate halos
 data_file = "/global/project/projectdirs/ProjectDisCo/Adam/turb/data/twodimturb_03_his.nc"
 data = Dataset(data_file)
-fullfield = data['vorticity'][transient:]
+vorticity = data['vorticity']
+driver = DiscoDriver(TimeAxis([data_file], len(vorticity)-transient), p_depth, f_depth, comm)
+# one netCDF variable sliced lazily, so every rank reads just its own steps rather than exchanging halos
+myfield = driver.load_array(vorticity, offset=transient)
 
-#fullfield = fullfield*fullfield #reconstructing from squared vorticity
+#myfield = myfield*myfield #reconstructing from squared vorticity
 if abs_val:
-    fullfield = np.absolute(fullfield) # reconstruct from absolute value of vorticity
-
-total = len(fullfield)
-n_procs = ceil((total - (p_depth+f_depth))/work) 
-last = n_procs - 1
-if rank == last:
-    myfield = np.copy(fullfield[rank*work : total])
-else:
-#     myfield = np.copy(fullfield[rank*work : (rank+1)*work + 2*halo])
-    myfield = np.copy(fullfield[rank*work : (rank+1)*work + (p_depth+f_depth)])
-del fullfield
+    myfield = np.absolute(myfield) # reconstruct from absolute value of vorticity
     
 
 # Initialize DiscoReconstructor object with past and future lightcone depths
-recon = DiscoReconstructor(p_depth, f_depth, c)
+recon = DiscoReconstructor(p_depth, f_depth, c, telemetry=True)
 
 # Extract lightcones from my subset of files
 recon.extract(myfield, boundary_condition='periodic')
 del myfield
 
-comm.Barrier()
+# slabs differ by at most one time step; report the measured imbalance
+counts, imbalance = driver.load_imbalance(len(recon.plcs))
+if rank == 0:
+    print('Lightcones per process: {} to {}, load imbalance: {:.1%}'.format(counts.min(), counts.max(), imbalance), flush=True)
 
 d4p.daalinit()
 recon.kmeans_lightcones(past_params, future_params, decay_type=decay_type, past_decay=p_decay, future_decay=f_decay, past_init_params=p_i_params, future_init_params=f_i_params,)
 recon.reconstruct_morphs()
-comm.Barrier()
-comm.Allreduce(recon.local_joint_dist, recon.global_joint_dist, op=MPI.SUM ) 
-recon.reconstruct_states(chi_squared)
+# start the joint distribution reduction and prepare the filter while it is in flight;
+# the state reconstruction waits for the reduction to complete
+recon.reduce_morphs(comm, blocking=False)
+recon.prepare_filter()
+# consensus of 32 random orderings of the pasts; every core already runs a process
+recon.reconstruct_states_ensemble(chi_squared, n_workers=1)
 recon.causal_filter()
+if rank == 0:
+    reduce_times = recon.reduce_times
+    # the reduction was only hidden behind the filter preparation if it completed during it
+    print('Joint distribution reduction: {} during {:.3f} s of filter preparation, then {:.3f} s waited'.format(
+            'completed' if reduce_times.completed else 'still in flight', reduce_times.in_flight, reduce_times.waited), flush=True)
+
+save_dir = '/global/project/projectdirs/ProjectDisCo/Adam/turb/results/result-{}/'.format(result)
+# all processes write their time steps into one netCDF file
+driver.write_states(save_dir+'states.nc', recon.state_field, dims=('time', 'y', 'x'))
 
-save_dir = '/global/project/projectdirs/ProjectDisCo/Adam/turb/results/result-{}/fields/'.format(result)
-save_name = 'turb_states_{:03d}'.format(rank)
-np.save(save_dir+save_name, recon.state_field)
+# wall time, CPU time and memory growth of every stage, over all processes
+summary = recon.telemetry_report(comm, path=save_dir+'telemetry.txt')
+if rank == 0:
+    print(summary, flush=True)
 
+# wait for all processes so the time to solution covers the whole job
 comm.Barrier()
 
 # print(rank, np.shape(recon.state_field), np.unique(recon.state_field))
@@ -2,10 +2,11 @@
 author: Adam Rupe
 email: atrupe@ucdavis.edu
 brief: animate climate segmentation results
-dependencies: python3, matplotlib, ffmpeg
+dependencies: python3, matplotlib, ffmpeg, netCDF4
 '''
 import os, sys
 from skimage.measure import label
+from netCDF4 import Dataset
 
 #Parent directory which contains the disco repo
 module_path = os.path.abspath(os.path.join('/global/common/software/ProjectDisCo/'))
@@ -19,15 +20,20 @@ vortex_states = [7]
 # file = "/global/project/projectdirs/ProjectDisCo/Adam/turb/data/abs_vort_kmeans_K-03.npy"
 # state_field = np.load(file)
 
-lcsdir = "/global/project/projectdirs/ProjectDisCo/Adam/turb/results/result-{}/fields/".format(result)
-lcsfiles = sorted(os.listdir(lcsdir))
-lcs_fields = []
-
-for file in lcsfiles:
-    lcs_field = np.load(lcsdir + file)
-    lcs_fields.append(lcs_field)
-
-state_field = np.vstack(lcs_fields)
+result_dir = "/global/project/projectdirs/ProjectDisCo/Adam/turb/results/result-{}/".format(result)
+
+if os.path.exists(result_dir+'states.nc'):
+    # state field written by turb.py, see DiscoDriver.write_states()
+    state_field = Dataset(result_dir+'states.nc', 'r')['states'][:]
+else:
+    # results from before states.nc were saved as one .npy file per process
+    lcsdir = result_dir+'fields/'
+    lcsfiles = sorted(os.listdir(lcsdir))
+    lcs_fields = []
+    for file in lcsfiles:
+        lcs_field = np.load(lcsdir + file)
+        lcs_fields.append(lcs_field)
+    state_field = np.vstack(lcs_fields)
 
 vortex_counts = []
 
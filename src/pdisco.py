@@ -1,13 +1,39 @@
+import os, sys, json, socket
 import numpy as np
 import daal4py as d4p
 
-from numba import njit
+from math import lgamma
+from numba import njit, prange
 from scipy.stats import chisquare
-from collections import Counter
-from itertools import product
+from scipy.sparse import csr_matrix, issparse
+from scipy.sparse.csgraph import connected_components
+from itertools import product, chain
+from time import perf_counter, process_time
+from functools import wraps
+from inspect import signature
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+try:
+    from resource import getrusage, RUSAGE_SELF
+except ImportError: # not on Windows; telemetry then records no memory use
+    getrusage = None
 
 
-def dist_from_data(X, Y, Nx, Ny):#, row_labels=False, column_labels=False):
+# relative tolerance scipy.stats.chisquare (scipy 1.10) allows between observed
+# and expected totals before raising a ValueError
+_CHISQUARE_RTOL = 1e-8
+
+# approximate bytes per MorphComparisonCache dictionary entry, besides its p values
+_CACHE_ENTRY_BYTES = 200
+
+# version of the on-disk format written by DiscoReconstructor.save()
+MODEL_FORMAT_VERSION = 1
+
+# pipeline stages DiscoReconstructor.checkpoint() can record, in pipeline order
+CHECKPOINT_STAGES = ('cluster', 'morphs', 'states')
+
+
+def dist_from_data(X, Y, Nx, Ny, sparse=False):#, row_labels=False, column_labels=False):
     '''
     Creates a conditional distribution P(X,Y) from sample observations of pairs (x,y).
     Joint distribution given as nd array. X and Y assumed to take values from
@@ -34,6 +60,10 @@ def dist_from_data(X, Y, Nx, Ny):#, row_labels=False, column_labels=False):
         of the distribution array. This extra row serves as a labels for Y;
         useful if permutations are performed on the distribution array.
 
+    sparse: bool, optional (default=False)
+        If True, returns the distribution as a scipy.sparse CSR matrix, which
+        only stores the observed (x,y) pairs.
+
     Returns
     -------
     dist: ndarray
@@ -41,14 +71,513 @@ def dist_from_data(X, Y, Nx, Ny):#, row_labels=False, column_labels=False):
         X and Y; dist[i,j] = P(X=i, Y=j). Rows and columns are conditional distributions,
         e.g. dist[i] = P(Y | X=i).
     '''
-    dist = np.zeros((Nx, Ny), dtype=np.uint64)
+    # flatten each (x,y) pair into a single index of the raveled (Nx, Ny) array
+    # and histogram those in one vectorized pass
+    flat = np.asarray(X, dtype=np.int64) * Ny
+    flat += np.asarray(Y, dtype=np.int64)
+
+    if sparse:
+        pairs, counts = np.unique(flat.ravel(), return_counts=True)
+        return csr_matrix((counts.astype(np.uint64), (pairs // Ny, pairs % Ny)), shape=(Nx, Ny))
+
+    dist = np.bincount(flat.ravel(), minlength=Nx*Ny).astype(np.uint64)
+
+    return dist.reshape(Nx, Ny)
+
+
+@njit(nogil=True)
+def _count_pairs(X, Y, counts):
+    # adds the counts of (x, y) label pairs into counts; releases the GIL, so
+    # chunks can be counted concurrently from a thread pool
+    for i in range(X.shape[0]):
+        counts[X[i], Y[i]] += 1
+
+
+def _morph_row(joint_dist, past):
+    # dense morph of a single past, from a dense or sparse joint distribution
+    if issparse(joint_dist):
+        return joint_dist[past].toarray()[0]
+    return joint_dist[past]
+
+
+def _set_csr_rows(matrix, rows, values):
+    # sets the given rows of a CSR matrix to the dense rows of values, touching
+    # only those rows: rows keeping their nonzero columns are written in place,
+    # and only if some change them are the CSR arrays spliced into new ones
+    if not matrix.has_canonical_format:
+        matrix.sum_duplicates()
+    indptr = matrix.indptr
+    columns = [np.flatnonzero(row_values) for row_values in values]
+    if all(np.array_equal(matrix.indices[indptr[row]:indptr[row+1]], cols)
+               for row, cols in zip(rows, columns)):
+        for row, cols, row_values in zip(rows, columns, values):
+            matrix.data[indptr[row]:indptr[row+1]] = row_values[cols]
+        return matrix
+
+    order = np.argsort(rows)
+    lengths = np.diff(indptr)
+    indices, data = [], []
+    previous = 0
+    for i in order:
+        row, cols = rows[i], columns[i]
+        indices += [matrix.indices[indptr[previous]:indptr[row]], cols]
+        data += [matrix.data[indptr[previous]:indptr[row]], values[i][cols]]
+        lengths[row] = len(cols)
+        previous = row + 1
+    indices.append(matrix.indices[indptr[previous]:])
+    data.append(matrix.data[indptr[previous]:])
+    new_indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(indptr.dtype)
+    return csr_matrix((np.concatenate(data).astype(matrix.dtype), np.concatenate(indices).astype(matrix.indices.dtype),
+                       new_indptr), shape=matrix.shape)
+
+
+class JointCounts(object):
+    '''
+    Mergeable accumulator for the joint distribution over pasts and futures.
+    Label chunks can be fed in incrementally with JointCounts.update(), so
+    the full arrays of past and future labels never need to be held in memory
+    at once. Partial counts from other chunks, processes, or MPI ranks are
+    combined with JointCounts.merge() (or +), JointCounts.allreduce(),
+    or JointCounts.reduce(). Instances pickle cleanly for multiprocessing
+    and can be saved to / loaded from disk.
+
+    The accumulated distribution is the attribute JointCounts.counts, a
+    uint64 array of shape (N_pasts, N_futures) in the same form returned
+    by dist_from_data(). With sparse=True it is instead a scipy.sparse CSR
+    matrix, so memory and MPI communication scale with the number of observed
+    (past, future) pairs rather than N_pasts*N_futures.
+    '''
+
+    def __init__(self, N_pasts, N_futures, counts=None, sparse=False):
+        '''
+        Parameters
+        ----------
+        N_pasts: int
+            Number of past lightcone clusters (pasts).
+
+        N_futures: int
+            Number of future lightcone clusters (futures).
+
+        counts: ndarray or sparse matrix, optional (default=None)
+            Initial (N_pasts, N_futures) array of counts. If None, starts
+            from all zeros. Sparse counts make the accumulator sparse.
+
+        sparse: bool, optional (default=False)
+            Store the counts as a scipy.sparse CSR matrix.
+        '''
+        self.N_pasts = N_pasts
+        self.N_futures = N_futures
+        self.sparse = sparse or issparse(counts)
+        if counts is not None and np.shape(counts) != (N_pasts, N_futures):
+            raise ValueError("counts must have shape (N_pasts, N_futures)")
+
+        if self.sparse:
+            if counts is None:
+                counts = (N_pasts, N_futures)
+            self.counts = csr_matrix(counts, dtype=np.uint64, copy=True)
+        elif counts is None:
+            self.counts = np.zeros((N_pasts, N_futures), dtype=np.uint64)
+        else:
+            self.counts = np.array(counts, dtype=np.uint64)
+
+    def _add(self, counts):
+        if self.sparse:
+            self.counts = self.counts + csr_matrix(counts, dtype=np.uint64)
+        elif issparse(counts):
+            self.counts += counts.toarray().astype(np.uint64)
+        else:
+            self.counts += counts
+
+    def update(self, pasts, futures, n_workers=1):
+        '''
+        Adds the counts of a chunk of (past, future) label pairs.
+
+        Parameters
+        ----------
+        pasts: array-like
+            Past lightcone cluster labels for the chunk.
+
+        futures: array-like
+            Future lightcone cluster labels for the same spacetime points as pasts.
+
+        n_workers: int, optional (default=1)
+            Number of threads counting dense counts, each into its own
+            JointCounts that are then merged. None uses all cores.
+        '''
+        if np.shape(pasts) != np.shape(futures):
+            raise ValueError("pasts and futures must have the same shape")
+        if n_workers is None:
+            n_workers = os.cpu_count()
+        if self.sparse or n_workers == 1:
+            self._add(dist_from_data(pasts, futures, self.N_pasts, self.N_futures, sparse=self.sparse))
+            return self
+
+        pasts = np.ravel(pasts)
+        futures = np.ravel(futures)
+        bounds = (np.arange(n_workers+1) * len(pasts)) // n_workers
+
+        def count(chunk):
+            a, b = chunk
+            counts = JointCounts(self.N_pasts, self.N_futures)
+            _count_pairs(pasts[a:b], futures[a:b], counts.counts)
+            return counts
+
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            for counts in pool.map(count, zip(bounds[:-1], bounds[1:])):
+                self.merge(counts)
+        return self
+
+    def merge(self, other):
+        '''
+        Adds the counts of another JointCounts instance into this one, in place.
+        '''
+        if (self.N_pasts, self.N_futures) != (other.N_pasts, other.N_futures):
+            raise ValueError("Can only merge JointCounts with the same N_pasts and N_futures")
+        self._add(other.counts)
+        return self
+
+    def copy(self):
+        return JointCounts(self.N_pasts, self.N_futures, self.counts, sparse=self.sparse)
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def __add__(self, other):
+        # also lets mpi4py object reductions, e.g. comm.allreduce(jc, op=MPI.SUM), work
+        return self.copy().merge(other)
+
+    @property
+    def total(self):
+        '''
+        Total number of (past, future) pairs counted.
+        '''
+        return int(self.counts.sum())
+
+    def allreduce(self, comm):
+        '''
+        Returns a new JointCounts with the counts summed over all ranks of the
+        given mpi4py communicator. Sparse counts are reduced as sparse matrices,
+        so only the observed pairs are communicated.
+        '''
+        from mpi4py import MPI
+        if self.sparse:
+            global_counts = comm.allreduce(self.counts, op=MPI.SUM)
+        else:
+            global_counts = np.zeros_like(self.counts)
+            comm.Allreduce(self.counts, global_counts, op=MPI.SUM)
+        return JointCounts(self.N_pasts, self.N_futures, global_counts)
+
+    def iallreduce(self, comm):
+        '''
+        Non-blocking form of .allreduce(). Starts summing the counts over all
+        ranks and returns (request, global_counts), where the new JointCounts
+        global_counts holds the sum once request.Wait() returns. Sparse counts
+        have no non-blocking reduction; they are summed before returning, with
+        an already completed request.
+        '''
+        from mpi4py import MPI
+        if self.sparse:
+            return MPI.REQUEST_NULL, self.allreduce(comm)
+        global_counts = JointCounts(self.N_pasts, self.N_futures)
+        request = comm.Iallreduce(self.counts, global_counts.counts, op=MPI.SUM)
+        return request, global_counts
+
+    def reduce(self, comm, root=0):
+        '''
+        Returns a new JointCounts with the counts summed over all ranks of the
+        given mpi4py communicator on the root rank, and None on all other ranks.
+        '''
+        from mpi4py import MPI
+        if self.sparse:
+            global_counts = comm.reduce(self.counts, op=MPI.SUM, root=root)
+        else:
+            global_counts = np.zeros_like(self.counts) if comm.Get_rank() == root else None
+            comm.Reduce(self.counts, global_counts, op=MPI.SUM, root=root)
+        if global_counts is None:
+            return None
+        return JointCounts(self.N_pasts, self.N_futures, global_counts)
+
+    def node_allreduce(self, node_comms):
+        '''
+        Hierarchical form of .allreduce() for hybrid runs, given the NodeComms of
+        split_node_comms(). The counts are summed on each node's leader rank,
+        then over the leaders, and broadcast back within each node, so only one
+        rank per node takes part in the inter-node reduction.
+        '''
+        request, global_counts = self.node_iallreduce(node_comms)
+        request.Wait()
+        return global_counts
+
+    def node_iallreduce(self, node_comms):
+        '''
+        Non-blocking form of .node_allreduce(). The node-local reduction
+        completes before returning; the reduction over node leaders is started
+        and returned as (request, global_counts), as for .iallreduce(), and
+        request.Wait() also broadcasts the result within the node. Sparse counts
+        are summed before returning.
+        '''
+        from mpi4py import MPI
+        node, leaders = node_comms
+        if self.sparse:
+            global_counts = node.reduce(self.counts, op=MPI.SUM, root=0)
+            if leaders is not None:
+                global_counts = leaders.allreduce(global_counts, op=MPI.SUM)
+            global_counts = node.bcast(global_counts, root=0)
+            return MPI.REQUEST_NULL, JointCounts(self.N_pasts, self.N_futures, global_counts)
+
+        global_counts = JointCounts(self.N_pasts, self.N_futures)
+        node.Reduce(self.counts, global_counts.counts, op=MPI.SUM, root=0)
+        if leaders is None:
+            request = MPI.REQUEST_NULL
+        else:
+            request = leaders.Iallreduce(MPI.IN_PLACE, global_counts.counts, op=MPI.SUM)
+        return _NodeRequest(request, node, global_counts.counts), global_counts
+
+    def save(self, path):
+        '''
+        Saves the accumulated counts to a .npz file.
+        '''
+        if self.sparse:
+            np.savez(path, data=self.counts.data, indices=self.counts.indices,
+                     indptr=self.counts.indptr, shape=self.counts.shape)
+        else:
+            np.savez(path, counts=self.counts)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Loads a JointCounts instance previously written with JointCounts.save().
+        '''
+        with np.load(path) as data:
+            if 'counts' in data:
+                counts = data['counts']
+            else:
+                counts = csr_matrix((data['data'], data['indices'], data['indptr']),
+                                    shape=tuple(data['shape']))
+        N_pasts, N_futures = counts.shape
+        return cls(N_pasts, N_futures, counts)
+
+
+class _NodeRequest(object):
+    # request of JointCounts.node_iallreduce(): waits for the reduction over
+    # node leaders, then broadcasts its result from each leader within its node
+    def __init__(self, request, node, counts):
+        self.request = request
+        self.node = node
+        self.counts = counts
+
+    def Test(self):
+        # only tests the reduction over node leaders, which other ranks are not part of
+        return self.request.Test()
+
+    def Wait(self):
+        self.request.Wait()
+        self.node.Bcast(self.counts, root=0)
+
+
+# communicators of a hybrid run: ranks sharing a node, and one leader rank per
+# node (None on the other ranks)
+NodeComms = namedtuple('NodeComms', ['node', 'leaders'])
+
+# timing of a non-blocking joint distribution reduction, see DiscoReconstructor.wait_morphs()
+ReduceTimes = namedtuple('ReduceTimes', ['in_flight', 'waited', 'completed'])
+
+
+def split_node_comms(comm, ranks_per_node=None):
+    '''
+    Splits an mpi4py communicator into the NodeComms of a hybrid run: the ranks
+    on each shared-memory node, and the node leaders (the lowest rank of every
+    node), for node-local reductions before the inter-node collective.
+
+    Parameters
+    ----------
+    comm: mpi4py communicator
+        Communicator of the run.
+
+    ranks_per_node: int, optional (default=None)
+        Group consecutive ranks into emulated nodes of this many ranks instead
+        of the actual shared-memory nodes, e.g. to benchmark on one machine.
+    '''
+    from mpi4py import MPI
+    rank = comm.Get_rank()
+    if ranks_per_node is None:
+        node = comm.Split_type(MPI.COMM_TYPE_SHARED, key=rank)
+    else:
+        node = comm.Split(rank // ranks_per_node, key=rank)
+    leaders = comm.Split(0 if node.Get_rank() == 0 else MPI.UNDEFINED, key=rank)
+    if leaders == MPI.COMM_NULL:
+        leaders = None
+    return NodeComms(node, leaders)
+
+
+class CausalStateTable(object):
+    '''
+    Struct-of-arrays container for all local causal states of a reconstruction.
+    Row s of each array belongs to one state:
+
+    CausalStateTable.indices[s]: integer label of the state
+    CausalStateTable.counts[s]: aggregate counts over futures from all pasts in the state
+    CausalStateTable.n_pasts[s]: number of pasts in the state
+    CausalStateTable.morphs[s]: counts averaged over the pasts in the state
+    CausalStateTable.normalized[s]: normalized morph of the state
+    CausalStateTable.entropies[s]: Shannon entropy of the morph, NaN until computed
+
+    and CausalStateTable.past_states[past] is the row of the state containing
+    past (-1 if not yet assigned). Only the first CausalStateTable.n_states rows
+    are in use. Merges update the rows in place, without any allocation.
+    '''
+
+    def __init__(self, N_pasts, N_futures, capacity=None):
+        '''
+        Parameters
+        ----------
+        N_pasts: int
+            Number of past lightcone clusters (pasts).
+
+        N_futures: int
+            Number of future lightcone clusters (futures), i.e. the length of a morph.
+
+        capacity: int, optional (default=None)
+            Number of state rows to preallocate. Defaults to N_pasts, the most
+            states there can be. The table grows if more are added.
+        '''
+        if capacity is None:
+            capacity = N_pasts
+        capacity = max(capacity, 1)
+        self.N_futures = N_futures
+        self.n_states = 0
+        self.indices = np.zeros(capacity, dtype=int)
+        self.counts = np.zeros((capacity, N_futures), dtype=np.uint64)
+        self.n_pasts = np.zeros(capacity, dtype=np.int64)
+        self.morphs = np.zeros((capacity, N_futures))
+        self.normalized = np.zeros((capacity, N_futures))
+        self.entropies = np.full(capacity, np.nan)
+        self.past_states = np.full(N_pasts, -1, dtype=np.int64)
+
+    def __len__(self):
+        return self.n_states
+
+    def _grow(self, past):
+        if self.n_states == len(self.indices):
+            extra = len(self.indices)
+            self.indices = np.concatenate((self.indices, np.zeros(extra, dtype=int)))
+            self.counts = np.vstack((self.counts, np.zeros_like(self.counts)))
+            self.n_pasts = np.concatenate((self.n_pasts, np.zeros(extra, dtype=np.int64)))
+            self.morphs = np.vstack((self.morphs, np.zeros_like(self.morphs)))
+            self.normalized = np.vstack((self.normalized, np.zeros_like(self.normalized)))
+            self.entropies = np.concatenate((self.entropies, np.full(extra, np.nan)))
+        if past >= len(self.past_states):
+            extra = past + 1 - len(self.past_states)
+            self.past_states = np.concatenate((self.past_states, np.full(extra, -1, dtype=np.int64)))
+
+    def _refresh(self, row):
+        # recompute the cached morph and normalized morph of the row in place
+        with np.errstate(invalid='ignore', divide='ignore'):
+            np.divide(self.counts[row], self.n_pasts[row], out=self.morphs[row])
+            np.divide(self.counts[row], self.counts[row].sum(), out=self.normalized[row])
+        self.entropies[row] = np.nan
+
+    def add_state(self, state_index, first_past, first_morph):
+        '''
+        Adds a new state containing first_past, with morph counts first_morph.
+        Returns the row of the new state.
+        '''
+        self._grow(first_past)
+        row = self.n_states
+        self.n_states += 1
+        self.indices[row] = state_index
+        self.counts[row] = first_morph
+        self.n_pasts[row] = 1
+        self.past_states[first_past] = row
+        self._refresh(row)
+        return row
+
+    def add_past(self, row, past, morph_counts):
+        '''
+        Adds past, with morph counts morph_counts, into the state at the given row
+        and updates the state's morph.
+        '''
+        self._grow(past)
+        self.counts[row] += morph_counts
+        self.n_pasts[row] += 1
+        self.past_states[past] = row
+        self._refresh(row)
+
+    def remove_past(self, row, past, morph_counts):
+        '''
+        Removes past, whose morph counts in the state are morph_counts, from the state
+        at the given row and updates the state's morph. A state left without
+        pasts keeps its row (and label) but is empty, with n_pasts[row] == 0,
+        until remove_empty() drops it.
+        '''
+        self.counts[row] -= np.asarray(morph_counts, dtype=np.uint64)
+        self.n_pasts[row] -= 1
+        self.past_states[past] = -1
+        self._refresh(row)
+
+    def remove_empty(self):
+        '''
+        Drops the states left without pasts by remove_past(), moving the rows
+        after them up so that only the first n_states rows stay in use. The
+        remaining states keep their labels, but may change rows. Returns the
+        labels of the dropped states.
+        '''
+        n = self.n_states
+        empty = self.n_pasts[:n] == 0
+        dropped = self.indices[:n][empty].tolist()
+        if not dropped:
+            return dropped
+        keep = np.flatnonzero(~empty)
+        new_rows = np.full(n, -1, dtype=np.int64)
+        new_rows[keep] = np.arange(len(keep))
+        for array, blank in ((self.indices, 0), (self.counts, 0), (self.n_pasts, 0),
+                             (self.morphs, 0), (self.normalized, 0), (self.entropies, np.nan)):
+            array[:len(keep)] = array[keep]
+            array[len(keep):n] = blank
+        assigned = self.past_states >= 0
+        self.past_states[assigned] = new_rows[self.past_states[assigned]]
+        self.n_states = len(keep)
+        return dropped
+
+    def pasts(self, row):
+        '''
+        Returns the set of pasts in the state at the given row.
+        '''
+        return set(np.flatnonzero(self.past_states == row).tolist())
 
-    counts = Counter(zip(X,Y))
+    def entropy(self, row):
+        '''
+        Returns the Shannon entropy of the morph of the state at the given row.
+        '''
+        if np.isnan(self.entropies[row]):
+            morph = self.normalized[row]
+            non_zero = morph[morph != 0]
+            self.entropies[row] = np.sum(-non_zero * np.log2(non_zero))
+        return self.entropies[row]
 
-    for pair, count in counts.items():
-        dist[pair] = count
+    def states(self):
+        '''
+        Returns a list of CausalState views, one for each state in the table.
+        '''
+        return [CausalState.view(self, row) for row in range(self.n_states)]
 
-    return dist
+    @classmethod
+    def from_arrays(cls, indices, counts, n_pasts, past_states):
+        '''
+        Rebuilds a table from its state labels, aggregate counts, membership
+        counts, and past -> row assignments, e.g. as stored by DiscoReconstructor.save().
+        The cached morphs are recomputed.
+        '''
+        n_states, N_futures = np.shape(counts)
+        table = cls(len(past_states), N_futures, capacity=n_states)
+        table.n_states = n_states
+        table.indices[:n_states] = indices
+        table.counts[:n_states] = counts
+        table.n_pasts[:n_states] = n_pasts
+        table.past_states[:] = past_states
+        for row in range(n_states):
+            table._refresh(row)
+        return table
 
 
 class CausalState(object):
@@ -57,7 +586,9 @@ class CausalState(object):
     the integer label for the state (State.index), the set of pasts in the
     state (State.pasts), and the weighted average morph for the state (State.morph).
 
-    Could just use a namedtuple, but for now keeping it as a class.
+    The data itself lives in one row of a CausalStateTable; a CausalState is a
+    lightweight view onto that row. A CausalState created directly (rather than
+    through CausalStateTable.states()) gets its own single-state table.
     '''
 
     def __init__(self, state_index, first_past, first_morph):
@@ -78,11 +609,39 @@ class CausalState(object):
             1D array of counts of futures seen with first_past, i.e.
             the (non-normalized) morph of first_past.
         '''
-        self.index = state_index
-        self.pasts = {first_past}
-        self.counts = np.copy(first_morph)
-        self.morph = np.copy(first_morph)
-        self.entropy = None
+        self._table = CausalStateTable(first_past + 1, len(first_morph), capacity=1)
+        self._row = self._table.add_state(state_index, first_past, first_morph)
+
+    @classmethod
+    def view(cls, table, row):
+        '''
+        Returns a CausalState view onto the given row of a CausalStateTable.
+        '''
+        state = cls.__new__(cls)
+        state._table = table
+        state._row = row
+        return state
+
+    @property
+    def index(self):
+        return self._table.indices[self._row]
+
+    @property
+    def pasts(self):
+        return self._table.pasts(self._row)
+
+    @property
+    def counts(self):
+        return self._table.counts[self._row]
+
+    @property
+    def morph(self):
+        return self._table.morphs[self._row]
+
+    @property
+    def entropy(self):
+        entropy = self._table.entropies[self._row]
+        return None if np.isnan(entropy) else entropy
 
     def update(self, past, morph_counts):
         '''
@@ -99,33 +658,209 @@ class CausalState(object):
             1D array of counts of futures seen with the new past being added into
             the state.
         '''
-        self.pasts.add(past)
-        self.counts += morph_counts
-        # average counts over the contributions from each past of the state
-        self.morph = np.copy(self.counts)
-        self.morph = np.divide(self.morph, len(self.pasts))
-        self.entropy = None
+        self._table.add_past(self._row, past, morph_counts)
 
     def normalized_morph(self):
         '''
-        Returns the normalized morph of the state.
-        This is not needed for the chi squared distribution comparison currently
-        used, so don't want to do this calculation unless desired. May be needed
-        in the future for different distribution comparisons.
+        Returns the normalized morph of the state. This is cached in the state
+        table, so the returned array should not be modified.
         '''
-        # OPT: memoize
-        morph = self.morph / np.sum(self.morph)
-        return morph
+        return self._table.normalized[self._row]
 
     def morph_entropy(self):
         '''
         Returns the Shannon entropy of the state's morph.
         '''
-        if self.entropy is None:
-            morph = self.normalized_morph()
-            non_zero = morph[morph != 0]
-            self.entropy = np.sum(-non_zero * np.log2(non_zero))
-        return self.entropy
+        return self._table.entropy(self._row)
+
+
+def reconstruct_causal_states(joint_dist, metric, *metric_args, pval_threshold=0.05, order=None,
+                                **metric_kwargs):
+    '''
+    Hierarchical agglomerative clustering of the morphs of a joint distribution
+    over pasts and futures into local causal states. Pasts are visited in the
+    given order; each is placed into the first existing state whose morph it
+    matches (p value > pval_threshold, or distance < pval_threshold for
+    distance metrics), or else starts a new state.
+
+    Parameters
+    ----------
+    joint_dist: ndarray or sparse matrix
+        (N_pasts, N_futures) joint distribution over pasts and futures.
+
+    metric: function
+        Distribution comparison function, see DiscoReconstructor.reconstruct_states().
+
+    pval_threshold: float, optional (default=0.05)
+        p value threshold for the distribution comparison, or distance threshold
+        for distance metrics.
+
+    order: array-like, optional (default=None)
+        Order in which pasts are clustered. Defaults to label order.
+
+    Returns
+    -------
+    table: CausalStateTable
+        The reconstructed local causal states. State labels start at 1, in
+        order of creation.
+
+    label_map: ndarray
+        Integer array mapping each past to the label of its local causal state.
+    '''
+    N_pasts, N_futures = np.shape(joint_dist)
+    sparse = issparse(joint_dist)
+    if sparse:
+        # morphs are densified one past at a time; start the state table small
+        joint_dist = csr_matrix(joint_dist)
+        table = CausalStateTable(N_pasts, N_futures, capacity=min(N_pasts, 64))
+    else:
+        table = CausalStateTable(N_pasts, N_futures)
+    label_map = np.zeros(N_pasts, dtype=int)
+    batch_metric = getattr(metric, 'batch', None)
+    normalized = batch_metric is not None and getattr(metric, 'normalized', False)
+    if normalized and not sparse:
+        # normalized past morphs are computed once, state ones are cached in the table
+        normalized_dist = normalize_morphs(joint_dist)
+
+    if order is None:
+        order = range(N_pasts)
+    for past in order:
+        morph = _morph_row(joint_dist, past)
+        row = None
+        if batch_metric is None:
+            for state_row in range(table.n_states):
+                p_value = metric(morph, table.morphs[state_row], *metric_args, **metric_kwargs)
+                if equivalent_morphs(p_value, pval_threshold, metric):
+                    row = state_row
+                    break
+        elif table.n_states > 0:
+            if normalized:
+                past_morph = normalize_morphs(morph) if sparse else normalized_dist[past]
+                p_values = batch_metric(past_morph, table.normalized[:table.n_states],
+                                        *metric_args, **metric_kwargs)
+            else:
+                p_values = batch_metric(morph, table.morphs[:table.n_states], *metric_args, **metric_kwargs)
+            # first matching state, same as the sequential comparison
+            matches = np.flatnonzero(equivalent_morphs(p_values, pval_threshold, metric))
+            if len(matches) > 0:
+                row = matches[0]
+
+        if row is None:
+            row = table.add_state(table.n_states + 1, past, morph)
+        else:
+            table.add_past(row, past, morph)
+        label_map[past] = table.indices[row]
+
+    return table, label_map
+
+
+def update_causal_states(table, label_map, joint_dist, pasts, count_deltas, metric, *metric_args,
+                         pval_threshold=0.05, **metric_kwargs):
+    '''
+    Incrementally updates reconstructed local causal states for new counts of
+    a few pasts, e.g. from streaming data. Only the given pasts are re-tested:
+    each is taken out of its state, its morph is updated with its count delta,
+    and it is placed into the first matching non-empty state (as in
+    reconstruct_causal_states()). If none matches it goes back to its old
+    state when that state is now empty, so its label is kept, and otherwise
+    starts a new state. States that are still left without pasts are then
+    dropped from the table (see CausalStateTable.remove_empty()), so every
+    state in it is non-empty. The cost is proportional to the number of
+    updated pasts.
+
+    Other pasts are not re-tested against the changed state morphs. Rerun
+    reconstruct_causal_states() from time to time to re-cluster from scratch.
+
+    Parameters
+    ----------
+    table: CausalStateTable
+        The current local causal states; updated in place.
+
+    label_map: ndarray
+        The current past -> state label map; updated in place.
+
+    joint_dist: ndarray or sparse matrix
+        The joint distribution the states were reconstructed from. Dense
+        distributions are updated in place, as are sparse (CSR) ones unless
+        new (past, future) pairs are observed; then only the CSR arrays are
+        rebuilt, around the updated rows.
+
+    pasts: array-like
+        Labels of the pasts with new counts.
+
+    count_deltas: array-like
+        (len(pasts), N_futures) array of counts to add to the morph of each past.
+
+    metric: function
+        Distribution comparison function, see DiscoReconstructor.reconstruct_states().
+
+    pval_threshold: float, optional (default=0.05)
+        Threshold for the distribution comparison.
+
+    Returns
+    -------
+    joint_dist: ndarray or sparse matrix
+        The updated joint distribution.
+
+    relabeled: dict
+        {past: (old_label, new_label)} for every past whose state changed.
+
+    removed: list
+        Labels of the states left empty and dropped from the table. No past
+        in label_map has these labels any more.
+    '''
+    pasts = np.asarray(pasts, dtype=np.int64)
+    count_deltas = np.atleast_2d(np.asarray(count_deltas, dtype=np.int64))
+    if count_deltas.shape != (len(pasts), table.N_futures):
+        raise ValueError("count_deltas must have shape (len(pasts), N_futures)")
+    if len(np.unique(pasts)) != len(pasts):
+        raise ValueError("pasts must not contain duplicates")
+
+    old_morphs = np.array([_morph_row(joint_dist, past) for past in pasts], dtype=np.int64)
+    new_morphs = old_morphs + count_deltas
+    if np.any(new_morphs < 0):
+        raise ValueError("count_deltas would make joint distribution counts negative")
+    new_morphs = new_morphs.astype(np.uint64)
+    if issparse(joint_dist):
+        joint_dist = _set_csr_rows(csr_matrix(joint_dist), pasts, new_morphs)
+    else:
+        joint_dist[pasts] = new_morphs
+
+    old_rows = table.past_states[pasts].copy()
+    for past, row, morph in zip(pasts, old_rows, old_morphs):
+        table.remove_past(row, past, morph)
+
+    batch_metric = getattr(metric, 'batch', None)
+    normalized = batch_metric is not None and getattr(metric, 'normalized', False)
+    relabeled = {}
+    for past, old_row, morph in zip(pasts, old_rows, new_morphs):
+        n = table.n_states
+        active = table.n_pasts[:n] > 0
+        if batch_metric is None:
+            scores = np.array([metric(morph, table.morphs[row], *metric_args, **metric_kwargs)
+                                if active[row] else np.nan for row in range(n)])
+        elif normalized:
+            scores = batch_metric(normalize_morphs(morph), table.normalized[:n], *metric_args, **metric_kwargs)
+        else:
+            scores = batch_metric(morph, table.morphs[:n], *metric_args, **metric_kwargs)
+        matches = np.flatnonzero(equivalent_morphs(scores, pval_threshold, metric) & active)
+
+        if len(matches) > 0:
+            row = matches[0]
+            table.add_past(row, past, morph)
+        elif table.n_pasts[old_row] == 0:
+            row = old_row
+            table.add_past(row, past, morph)
+        else:
+            row = table.add_state(np.max(table.indices[:n]) + 1, past, morph)
+
+        old_label = label_map[past]
+        label_map[past] = table.indices[row]
+        if label_map[past] != old_label:
+            relabeled[int(past)] = (int(old_label), int(label_map[past]))
+
+    removed = table.remove_empty()
+    return joint_dist, relabeled, removed
 
 
 def chi_squared(X, Y, *args, offset=10, **kwargs):
@@ -164,6 +899,799 @@ def chi_squared(X, Y, *args, offset=10, **kwargs):
     return pval
 
 
+@njit(nogil=True)
+def _regularized_gamma_q(a, x):
+    '''
+    Regularized upper incomplete gamma function Q(a, x), using the series
+    expansion for x < a+1 and the continued fraction (modified Lentz) otherwise.
+    '''
+    if a <= 0 or x < 0 or np.isnan(x):
+        return np.nan
+    if x == 0:
+        return 1.0
+    log_prefactor = a*np.log(x) - x - lgamma(a)
+    eps = 1e-16
+    tiny = 1e-300
+    if x < a + 1:
+        term = 1.0 / a
+        total = term
+        ap = a
+        for _ in range(100000):
+            ap += 1
+            term *= x / ap
+            total += term
+            if abs(term) < abs(total)*eps:
+                break
+        return 1.0 - total*np.exp(log_prefactor)
+    else:
+        b = x + 1 - a
+        cf = 1.0 / tiny
+        d = 1.0 / b
+        h = d
+        for i in range(1, 100000):
+            an = -i*(i - a)
+            b += 2
+            d = an*d + b
+            if abs(d) < tiny:
+                d = tiny
+            cf = b + an/cf
+            if abs(cf) < tiny:
+                cf = tiny
+            d = 1.0 / d
+            delta = d*cf
+            h *= delta
+            if abs(delta - 1.0) < eps:
+                break
+        return h*np.exp(log_prefactor)
+
+
+@njit(nogil=True)
+def chi2_sf(x, dof):
+    '''
+    Survival function (1 - CDF) of the chi squared distribution with dof
+    degrees of freedom. Numba equivalent of scipy.stats.chi2.sf(x, dof).
+    '''
+    return _regularized_gamma_q(dof/2, x/2)
+
+
+@njit(nogil=True)
+def _chi_squared_pvalue(x, y, offset, dof):
+    '''
+    1-way chi squared p value of observed counts x against expected counts y,
+    both offset as in chi_squared().
+    '''
+    obs_sum = 0.0
+    exp_sum = 0.0
+    for j in range(len(x)):
+        obs_sum += x[j] + offset
+        exp_sum += y[j] + offset
+    # scipy.stats.chisquare raises a ValueError (which chi_squared() maps
+    # to a p value of 0) when the total counts do not agree
+    if abs(obs_sum - exp_sum) > _CHISQUARE_RTOL*min(obs_sum, exp_sum):
+        return 0.0
+    stat = 0.0
+    for j in range(len(x)):
+        expected = y[j] + offset
+        diff = x[j] + offset - expected
+        stat += diff*diff / expected
+    return chi2_sf(stat, dof)
+
+
+@njit(nogil=True)
+def _chi_squared_pvalues(X, Y, offset, ddof):
+    '''
+    Row-wise 1-way chi squared p values of observed counts X[i] against
+    expected counts Y[i], both offset as in chi_squared().
+    '''
+    M, K = X.shape
+    dof = K - 1 - ddof
+    pvals = np.empty(M)
+    for i in range(M):
+        pvals[i] = _chi_squared_pvalue(X[i], Y[i], offset, dof)
+    return pvals
+
+
+@njit(nogil=True)
+def _chi_squared_label_map(joint_dist, order, pval_threshold, offset, ddof):
+    '''
+    label_map of reconstruct_causal_states() with the chi_squared metric on a
+    dense joint distribution, compiled as a whole so that it runs without the
+    GIL. State morphs are kept as in CausalStateTable, so the result is the same.
+    '''
+    N_pasts, N_futures = joint_dist.shape
+    dof = N_futures - 1 - ddof
+    counts = np.zeros((N_pasts, N_futures), dtype=np.uint64)
+    morphs = np.empty((N_pasts, N_futures))
+    n_pasts = np.zeros(N_pasts, dtype=np.uint64)
+    morph = np.empty(N_futures)
+    label_map = np.zeros(N_pasts, dtype=np.int64)
+    n_states = 0
+    for past in order:
+        for j in range(N_futures):
+            morph[j] = joint_dist[past, j]
+        row = n_states
+        for state_row in range(n_states):
+            if _chi_squared_pvalue(morph, morphs[state_row], offset, dof) > pval_threshold:
+                row = state_row
+                break
+        if row == n_states:
+            n_states += 1
+        for j in range(N_futures):
+            counts[row, j] += np.uint64(joint_dist[past, j])
+        n_pasts[row] += 1
+        for j in range(N_futures):
+            morphs[row, j] = counts[row, j] / n_pasts[row]
+        label_map[past] = row + 1
+    return label_map
+
+
+def chi_squared_batch(X, Y, ddof=0, offset=10):
+    '''
+    Batched version of chi_squared(). Compares the morph(s) X against the
+    morph(s) Y row by row in a single vectorized call, broadcasting a single
+    morph against a stacked matrix of morphs. In our use, X is the morph of
+    a past and Y the stacked morphs of all current local causal states.
+
+    Returns the same p values as calling chi_squared() on each pair of rows.
+
+    Parameters
+    ----------
+    X: array
+        1D array of counts, or 2D array with one histogram per row.
+
+    Y: array
+        1D array of counts, or 2D array with one histogram per row.
+
+    ddof: int, optional (default=0)
+        Delta degrees of freedom, as for scipy.stats.chisquare.
+
+    offset: int, optional (default=10)
+        Count added to every bin of X and Y, as for chi_squared().
+
+    Returns
+    -------
+    pvals: array
+        1D array of p values, one for each row of the broadcast X and Y.
+    '''
+    X, Y = _broadcast_rows(X, Y)
+    return _chi_squared_pvalues(X, Y, float(offset), ddof)
+
+
+def register_batch_metric(metric, batch, normalized=False, distance=False):
+    '''
+    Registers a batched counterpart for a distribution comparison metric. Metrics
+    with a batched counterpart are used through it by reconstruct_states, which
+    then compares each past against all current states in a single call.
+
+    Parameters
+    ----------
+    metric: function
+        Scalar metric, metric(X, Y, *args, **kwargs), taking two arrays of counts.
+
+    batch: function
+        Batched metric, batch(X, Y, *args, **kwargs), comparing the rows of X and Y
+        (broadcast against each other) and returning a 1D array of results.
+
+    normalized: bool, optional (default=False)
+        If True, batch is given normalized morphs (rows summing to 1) rather than counts.
+        Normalized morphs of the states are cached, so this costs nothing extra.
+
+    distance: bool, optional (default=False)
+        If True, the metric returns a distance rather than a p value, and two
+        morphs are considered equivalent if their distance is below the threshold.
+    '''
+    metric.batch = batch
+    metric.normalized = normalized
+    metric.distance = distance
+
+
+def equivalent_morphs(scores, threshold, metric):
+    '''
+    Returns whether metric comparison results are considered equivalent
+    morphs: p values above threshold, or distances below it for distance metrics.
+    '''
+    if getattr(metric, 'distance', False):
+        return np.less(scores, threshold)
+    return np.greater(scores, threshold)
+
+
+def normalize_morphs(morphs):
+    '''
+    Returns the morphs (rows of counts) normalized to sum to 1. All-zero rows become NaN.
+    '''
+    morphs = np.asarray(morphs, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return morphs / morphs.sum(axis=-1, keepdims=True)
+
+
+def _broadcast_rows(X, Y):
+    X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+    Y = np.atleast_2d(np.asarray(Y, dtype=np.float64))
+    shape = np.broadcast_shapes(X.shape, Y.shape)
+    return np.broadcast_to(X, shape), np.broadcast_to(Y, shape)
+
+
+register_batch_metric(chi_squared, chi_squared_batch)
+
+
+@njit(nogil=True)
+def _hellinger_rows(P, Q):
+    M, K = P.shape
+    out = np.empty(M)
+    for i in range(M):
+        total = 0.0
+        for j in range(K):
+            diff = np.sqrt(P[i,j]) - np.sqrt(Q[i,j])
+            total += diff*diff
+        out[i] = np.sqrt(0.5*total)
+    return out
+
+
+@njit(nogil=True)
+def _total_variation_rows(P, Q):
+    M, K = P.shape
+    out = np.empty(M)
+    for i in range(M):
+        total = 0.0
+        for j in range(K):
+            total += abs(P[i,j] - Q[i,j])
+        out[i] = 0.5*total
+    return out
+
+
+@njit(nogil=True)
+def _jensen_shannon_rows(P, Q):
+    M, K = P.shape
+    out = np.empty(M)
+    for i in range(M):
+        total = 0.0
+        for j in range(K):
+            m = 0.5*(P[i,j] + Q[i,j])
+            if P[i,j] > 0:
+                total += 0.5*P[i,j]*np.log2(P[i,j]/m)
+            if Q[i,j] > 0:
+                total += 0.5*Q[i,j]*np.log2(Q[i,j]/m)
+        # clip tiny negative round-off before the square root
+        out[i] = np.sqrt(max(total, 0.0))
+    return out
+
+
+@njit(nogil=True, error_model='numpy')
+def _kl_divergence_rows(P, Q, smoothing):
+    M, K = P.shape
+    out = np.empty(M)
+    norm = 1.0 + K*smoothing
+    for i in range(M):
+        total = 0.0
+        for j in range(K):
+            p = (P[i,j] + smoothing) / norm
+            q = (Q[i,j] + smoothing) / norm
+            if p > 0:
+                total += p*np.log2(p/q)
+        out[i] = total
+    return out
+
+
+def hellinger_batch(X, Y):
+    '''
+    Batched Hellinger distance between the rows of normalized morphs X and Y
+    (broadcast against each other). Distances lie in [0, 1].
+    '''
+    return _hellinger_rows(*_broadcast_rows(X, Y))
+
+
+def total_variation_batch(X, Y):
+    '''
+    Batched total variation distance between the rows of normalized morphs X and Y
+    (broadcast against each other). Distances lie in [0, 1].
+    '''
+    return _total_variation_rows(*_broadcast_rows(X, Y))
+
+
+def jensen_shannon_batch(X, Y):
+    '''
+    Batched Jensen-Shannon distance (square root of the base 2 Jensen-Shannon
+    divergence) between the rows of normalized morphs X and Y (broadcast
+    against each other). Distances lie in [0, 1].
+    '''
+    return _jensen_shannon_rows(*_broadcast_rows(X, Y))
+
+
+def kl_divergence_batch(X, Y, smoothing=1e-6):
+    '''
+    Batched Kullback-Leibler divergence D(X||Y), in bits, between the rows of
+    normalized morphs X and Y (broadcast against each other). Both are
+    additively smoothed, (p + smoothing) / (1 + N_futures*smoothing), so
+    futures unseen in Y give a large but finite divergence.
+    '''
+    return _kl_divergence_rows(*_broadcast_rows(X, Y), float(smoothing))
+
+
+def hellinger(X, Y):
+    '''
+    Returns the Hellinger distance between the empirical distributions
+    with counts (histograms) X and Y.
+    '''
+    return hellinger_batch(normalize_morphs(X), normalize_morphs(Y))[0]
+
+
+def total_variation(X, Y):
+    '''
+    Returns the total variation distance between the empirical distributions
+    with counts (histograms) X and Y.
+    '''
+    return total_variation_batch(normalize_morphs(X), normalize_morphs(Y))[0]
+
+
+def jensen_shannon(X, Y):
+    '''
+    Returns the Jensen-Shannon distance between the empirical distributions
+    with counts (histograms) X and Y.
+    '''
+    return jensen_shannon_batch(normalize_morphs(X), normalize_morphs(Y))[0]
+
+
+def kl_divergence(X, Y, smoothing=1e-6):
+    '''
+    Returns the smoothed Kullback-Leibler divergence D(X||Y), in bits, between
+    the empirical distributions with counts (histograms) X and Y.
+    In our use, X should be the morph for a past, and Y the morph for a
+    local causal state.
+    '''
+    return kl_divergence_batch(normalize_morphs(X), normalize_morphs(Y), smoothing)[0]
+
+
+register_batch_metric(hellinger, hellinger_batch, normalized=True, distance=True)
+register_batch_metric(total_variation, total_variation_batch, normalized=True, distance=True)
+register_batch_metric(jensen_shannon, jensen_shannon_batch, normalized=True, distance=True)
+register_batch_metric(kl_divergence, kl_divergence_batch, normalized=True, distance=True)
+
+
+class MorphComparisonCache(object):
+    '''
+    Cache of metric comparisons between the morphs of pasts and of local causal
+    states, shared between reconstructions of the same joint distribution for
+    different p value thresholds.
+
+    Clustering visits the pasts in order, and the states a past is compared
+    against are fully determined by the decisions made for the pasts before it
+    (the configuration). Every configuration gets an integer id from the one
+    before it and the last decision, and the p values of the next past against
+    its states are cached by that id. Reconstructions for different thresholds
+    share configurations until their first differing decision, and repeated
+    sweeps share all of them. At most max_bytes (roughly) are kept; further
+    configurations are compared but not stored.
+    '''
+
+    def __init__(self, joint_dist, metric, *metric_args, max_bytes=2**28, **metric_kwargs):
+        '''
+        Parameters
+        ----------
+        joint_dist: ndarray or sparse matrix
+            (N_pasts, N_futures) joint distribution over pasts and futures.
+
+        metric: function
+            Distribution comparison function, as for DiscoReconstructor.reconstruct_states().
+
+        max_bytes: int, optional (default=2**28)
+            Bound on the memory used by the cache.
+        '''
+        self.morphs = joint_dist
+        self._rows = csr_matrix(joint_dist) if issparse(joint_dist) else np.asarray(joint_dist)
+        self.metric = metric
+        self.metric_args = metric_args
+        self.metric_kwargs = metric_kwargs
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._batch = getattr(metric, 'batch', None)
+        self._normalized = self._batch is not None and getattr(metric, 'normalized', False)
+        self._configurations = {}
+        self._n_configurations = 1 # 0 is the empty configuration
+        self._scores = {}
+
+    def __len__(self):
+        return len(self._scores)
+
+    def next_configuration(self, configuration, row):
+        '''
+        Returns the id of the configuration following the given one when the
+        past it was compared for joins the state at row (None for a new state).
+        '''
+        key = (configuration, -1 if row is None else int(row))
+        following = self._configurations.get(key)
+        if following is None:
+            following = self._n_configurations
+            self._n_configurations += 1
+            if self.nbytes < self.max_bytes:
+                self._configurations[key] = following
+                self.nbytes += _CACHE_ENTRY_BYTES
+        return following
+
+    def first_match(self, configuration, morph, table, pval_threshold):
+        '''
+        Returns the first row of the state table whose morph matches the given
+        morph of the next past in the given configuration, or None, as
+        reconstruct_causal_states() clusters it.
+        '''
+        n = table.n_states
+        if n == 0:
+            return None
+        scores = self._scores.get(configuration)
+        if self._batch is None:
+            # sequential comparisons stop at the first match; a cached prefix
+            # of p values is extended if a higher threshold needs more of them
+            if scores is None:
+                scores = []
+            for row in range(n):
+                if row == len(scores):
+                    scores.append(self.metric(morph, table.morphs[row], *self.metric_args, **self.metric_kwargs))
+                if equivalent_morphs(scores[row], pval_threshold, self.metric):
+                    break
+            self._store(configuration, scores)
+            matches = np.flatnonzero(equivalent_morphs(np.array(scores), pval_threshold, self.metric))
+        else:
+            if scores is None:
+                if self._normalized:
+                    scores = self._batch(normalize_morphs(morph), table.normalized[:n],
+                                         *self.metric_args, **self.metric_kwargs)
+                else:
+                    scores = self._batch(morph, table.morphs[:n], *self.metric_args, **self.metric_kwargs)
+                self._store(configuration, scores)
+            matches = np.flatnonzero(equivalent_morphs(scores, pval_threshold, self.metric))
+        return matches[0] if len(matches) > 0 else None
+
+    def _store(self, configuration, scores):
+        if configuration in self._scores:
+            old = self._scores[configuration]
+            self.nbytes += 8*(len(scores) - len(old))
+            self._scores[configuration] = scores
+        elif self.nbytes < self.max_bytes:
+            self._scores[configuration] = scores
+            self.nbytes += _CACHE_ENTRY_BYTES + 8*len(scores)
+
+
+def sweep_states(joint_dist, metric, thresholds, *metric_args, cache=None, **metric_kwargs):
+    '''
+    Reconstructs local causal states from the same joint distribution for each
+    of the given p value thresholds, with the same agglomerative clustering as
+    reconstruct_causal_states(). Comparisons are shared between thresholds,
+    and with earlier sweeps, through a MorphComparisonCache, so a sweep costs
+    at most as much as reconstructing the states for each threshold separately.
+
+    Parameters
+    ----------
+    joint_dist: ndarray or sparse matrix
+        (N_pasts, N_futures) joint distribution over pasts and futures.
+
+    metric: function
+        Distribution comparison function, as for DiscoReconstructor.reconstruct_states().
+
+    thresholds: array-like
+        p value thresholds (or distance thresholds, for distance metrics) to
+        reconstruct states for.
+
+    cache: MorphComparisonCache, optional (default=None)
+        Cache to reuse from a previous sweep over the same joint distribution
+        and metric. A new one is created if None.
+
+    Returns
+    -------
+    label_maps: ndarray
+        Integer array of shape (len(thresholds), N_pasts); label_maps[i] is the
+        label_map (past -> local causal state label) for thresholds[i].
+
+    n_states: ndarray
+        Number of local causal states reconstructed for each threshold.
+    '''
+    if cache is None:
+        cache = MorphComparisonCache(joint_dist, metric, *metric_args, **metric_kwargs)
+    rows = cache._rows
+    N_pasts, N_futures = rows.shape
+
+    label_maps = np.zeros((len(thresholds), N_pasts), dtype=int)
+    n_states = np.zeros(len(thresholds), dtype=int)
+    for i, pval_threshold in enumerate(thresholds):
+        table = CausalStateTable(N_pasts, N_futures, capacity=min(N_pasts, 64))
+        configuration = 0
+        for past in range(N_pasts):
+            morph = _morph_row(rows, past)
+            row = cache.first_match(configuration, morph, table, pval_threshold)
+            configuration = cache.next_configuration(configuration, row)
+            if row is None:
+                row = table.add_state(table.n_states + 1, past, morph)
+            else:
+                table.add_past(row, past, morph)
+            label_maps[i, past] = row + 1
+        n_states[i] = table.n_states
+
+    return label_maps, n_states
+
+
+def state_table_from_labels(joint_dist, label_map):
+    '''
+    Builds the CausalStateTable for a given assignment of pasts to local causal
+    states, e.g. a consensus label_map. label_map must use the labels 1,2,...
+    in order of first appearance over the pasts, so state rows are label - 1.
+    '''
+    N_pasts, N_futures = np.shape(joint_dist)
+    table = CausalStateTable(N_pasts, N_futures, capacity=np.max(label_map))
+    if issparse(joint_dist):
+        joint_dist = csr_matrix(joint_dist)
+    for past, label in enumerate(label_map):
+        morph = _morph_row(joint_dist, past)
+        if label > table.n_states:
+            table.add_state(label, past, morph)
+        else:
+            table.add_past(label - 1, past, morph)
+    return table
+
+
+def coassignment(label_maps):
+    '''
+    Returns the (N_pasts, N_pasts) array of the fraction of the given label_maps
+    in which each pair of pasts is assigned to the same local causal state.
+
+    Parameters
+    ----------
+    label_maps: ndarray
+        Integer array of shape (n_replicates, N_pasts), one label_map per row.
+    '''
+    label_maps = np.atleast_2d(label_maps)
+    n_replicates, N_pasts = label_maps.shape
+    together = np.zeros((N_pasts, N_pasts))
+    for label_map in label_maps:
+        # one-hot state membership, so co-membership is a single matrix product
+        _, labels = np.unique(label_map, return_inverse=True)
+        onehot = np.zeros((N_pasts, labels.max() + 1))
+        onehot[np.arange(N_pasts), labels] = 1
+        together += onehot @ onehot.T
+    return together / n_replicates
+
+
+def consensus_states(label_maps):
+    '''
+    Combines an ensemble of label_maps into a consensus label_map. Pasts assigned
+    to the same state in a majority of the ensemble are linked, and the consensus
+    states are the connected components of those links.
+
+    Parameters
+    ----------
+    label_maps: ndarray
+        Integer array of shape (n_replicates, N_pasts), one label_map per row.
+
+    Returns
+    -------
+    label_map: ndarray
+        Consensus label_map, with labels 1,2,... in order of first appearance.
+
+    stability: ndarray
+        Per-past stability score in [0, 1]: the average agreement, over all other
+        pasts, between the ensemble and the consensus on whether the two pasts
+        share a state. 1 means every replicate agrees with the consensus.
+
+    together: ndarray
+        Co-assignment frequencies of all pairs of pasts, see coassignment().
+    '''
+    together = coassignment(label_maps)
+    _, components = connected_components(csr_matrix(together > 0.5), directed=False)
+    # relabel components 1,2,... in order of first appearance over the pasts
+    _, first = np.unique(components, return_index=True)
+    relabel = np.zeros(len(first), dtype=int)
+    relabel[np.argsort(first)] = np.arange(1, len(first) + 1)
+    label_map = relabel[components]
+
+    same = label_map[:, np.newaxis] == label_map[np.newaxis, :]
+    stability = 1 - np.abs(together - same).mean(axis=1)
+    return label_map, stability, together
+
+
+def _compiled_clustering(joint_dist, metric, metric_args, metric_kwargs):
+    # (offset, ddof) for _chi_squared_label_map() if it can cluster with this
+    # metric and joint distribution, else None
+    if metric is not chi_squared or issparse(joint_dist) or not np.issubdtype(np.asarray(joint_dist).dtype, np.integer):
+        return None
+    try:
+        arguments = signature(chi_squared_batch).bind(None, None, *metric_args, **metric_kwargs)
+    except TypeError:
+        return None
+    arguments.apply_defaults()
+    return float(arguments.arguments['offset']), int(arguments.arguments['ddof'])
+
+
+def _ordered_label_map(args):
+    joint_dist, metric, metric_args, pval_threshold, order, metric_kwargs = args
+    compiled = _compiled_clustering(joint_dist, metric, metric_args, metric_kwargs)
+    if compiled is not None:
+        offset, ddof = compiled
+        return _chi_squared_label_map(np.asarray(joint_dist), order, float(pval_threshold), offset, ddof)
+    _, label_map = reconstruct_causal_states(joint_dist, metric, *metric_args,
+                                             pval_threshold=pval_threshold, order=order,
+                                             **metric_kwargs)
+    return label_map
+
+
+def permutation_ensemble(joint_dist, metric, *metric_args, pval_threshold=0.05, n_permutations=32,
+                         n_workers=None, seed=0, processes=None, **metric_kwargs):
+    '''
+    Runs reconstruct_causal_states() for n_permutations random orderings of the
+    pasts in parallel, as the greedy agglomeration depends on the order in
+    which pasts are visited. With chi_squared on a dense joint distribution of
+    counts each ordering is clustered in a single compiled call that releases
+    the GIL, so threads scale; other metrics run the Python clustering loop,
+    which holds the GIL outside the metric, and are best run in processes.
+
+    Parameters
+    ----------
+    joint_dist: ndarray
+        (N_pasts, N_futures) joint distribution over pasts and futures.
+
+    metric: function
+        Distribution comparison function, see DiscoReconstructor.reconstruct_states().
+
+    pval_threshold: float, optional (default=0.05)
+        Threshold for the distribution comparison.
+
+    n_permutations: int, optional (default=32)
+        Number of random orderings of the pasts.
+
+    n_workers: int, optional (default=None)
+        Number of pool workers. None uses the executor default.
+
+    seed: int, optional (default=0)
+        Seed for the permutations. Must be the same on every rank of a
+        distributed run so all ranks reconstruct the same states.
+
+    processes: bool, optional (default=None)
+        Use a process pool instead of a thread pool. None uses threads, which
+        are safe to start inside MPI ranks, for the compiled chi_squared
+        clustering and processes otherwise.
+
+    Returns
+    -------
+    label_maps: ndarray
+        Integer array of shape (n_permutations, N_pasts), one label_map per ordering.
+    '''
+    N_pasts = np.shape(joint_dist)[0]
+    rng = np.random.default_rng(seed)
+    tasks = [(joint_dist, metric, metric_args, pval_threshold, rng.permutation(N_pasts), metric_kwargs)
+                for _ in range(n_permutations)]
+    if processes is None:
+        processes = _compiled_clustering(joint_dist, metric, metric_args, metric_kwargs) is None
+    Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with Executor(n_workers) as pool:
+        label_maps = list(pool.map(_ordered_label_map, tasks))
+    return np.array(label_maps)
+
+
+def resample_joint_counts(joint_dist, rng, method='multinomial', block_counts=None):
+    '''
+    Returns a bootstrap resample of a joint distribution over pasts and futures.
+
+    Parameters
+    ----------
+    joint_dist: ndarray or sparse matrix
+        (N_pasts, N_futures) joint distribution. Used by the 'multinomial' method.
+
+    rng: numpy.random.Generator
+        Random number generator for the resample.
+
+    method: str, optional (default='multinomial')
+        'multinomial' draws the same total number of (past, future) pairs from
+        the empirical joint distribution; an all-zero distribution resamples to
+        all zeros. 'block' resamples time blocks with
+        replacement from block_counts and sums them, which keeps the temporal
+        correlations within each block.
+
+    block_counts: ndarray or list, optional (default=None)
+        (n_blocks, N_pasts, N_futures) joint counts of each time block, or a
+        list of one (N_pasts, N_futures) array or sparse matrix per block, see
+        DiscoReconstructor.reconstruct_morphs(time_block=...). Required for 'block'.
+    '''
+    if method == 'multinomial':
+        if issparse(joint_dist):
+            # unobserved pairs have zero probability, so only resample the stored entries
+            resample = csr_matrix(joint_dist, dtype=np.uint64, copy=True)
+            counts = resample.data
+        else:
+            resample = np.array(joint_dist, dtype=np.uint64)
+            counts = resample.ravel()
+        total = int(counts.sum())
+        if total == 0:
+            return resample # nothing to draw, and no probabilities to draw it with
+        probabilities = counts / total
+        counts[:] = rng.multinomial(total, probabilities / probabilities.sum())
+        return resample
+    elif method == 'block':
+        if block_counts is None:
+            raise ValueError("block_counts are required for method='block'")
+        blocks = rng.integers(0, len(block_counts), size=len(block_counts))
+        # add each drawn block once, weighted by the number of times it was drawn
+        resample = None
+        for block, weight in enumerate(np.bincount(blocks, minlength=len(block_counts))):
+            if weight > 0:
+                weighted = block_counts[block].astype(np.uint64) * np.uint64(weight)
+                resample = weighted if resample is None else resample + weighted
+        return resample
+    else:
+        raise ValueError("method must be either 'multinomial' or 'block'")
+
+
+# (joint_dist, block_counts) of the bootstrap_states() call a pool worker serves
+_bootstrap_counts = None
+
+
+def _init_bootstrap_worker(joint_dist, block_counts):
+    # pool initializer, so the counts reach each worker once rather than with every task
+    global _bootstrap_counts
+    _bootstrap_counts = (joint_dist, block_counts)
+
+
+def _bootstrap_label_map(args):
+    method, seed, metric, metric_args, pval_threshold, metric_kwargs = args
+    joint_dist, block_counts = _bootstrap_counts
+    resample = resample_joint_counts(joint_dist, np.random.default_rng(seed), method, block_counts)
+    return _ordered_label_map((resample, metric, metric_args, pval_threshold,
+                                np.arange(resample.shape[0]), metric_kwargs))
+
+
+def bootstrap_states(joint_dist, metric, *metric_args, pval_threshold=0.05, n_replicates=100,
+                     method='multinomial', block_counts=None, n_workers=None, seed=0, processes=True,
+                     **metric_kwargs):
+    '''
+    Bootstrap estimate of how stable local causal state assignments are under
+    sampling noise. The joint counts are resampled n_replicates times (see
+    resample_joint_counts()) and reconstruct_causal_states() is rerun on each
+    replicate in a pool of workers.
+
+    Parameters
+    ----------
+    joint_dist: ndarray or sparse matrix
+        (N_pasts, N_futures) joint distribution over pasts and futures.
+
+    metric: function
+        Distribution comparison function, see DiscoReconstructor.reconstruct_states().
+
+    pval_threshold: float, optional (default=0.05)
+        Threshold for the distribution comparison.
+
+    n_replicates: int, optional (default=100)
+        Number of bootstrap replicates.
+
+    method: str, optional (default='multinomial')
+        'multinomial' or 'block', see resample_joint_counts().
+
+    block_counts: ndarray or list, optional (default=None)
+        Per time block joint counts, required for method='block'.
+
+    n_workers: int, optional (default=None)
+        Number of pool workers. None uses the executor default.
+
+    seed: int, optional (default=0)
+        Seed for the resampling; each replicate gets an independent stream.
+
+    processes: bool, optional (default=True)
+        Use a process pool. Set to False for a thread pool, e.g. inside MPI ranks.
+
+    Returns
+    -------
+    together: ndarray
+        (N_pasts, N_pasts) array of the fraction of replicates in which each pair
+        of pasts is assigned to the same state, see coassignment().
+
+    label_maps: ndarray
+        Integer array of shape (n_replicates, N_pasts), one label_map per replicate.
+    '''
+    if method == 'block':
+        joint_dist = None # not needed by the workers
+    seeds = np.random.SeedSequence(seed).spawn(n_replicates)
+    tasks = [(method, replicate_seed, metric, metric_args, pval_threshold, metric_kwargs)
+                for replicate_seed in seeds]
+    Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with Executor(n_workers, initializer=_init_bootstrap_worker, initargs=(joint_dist, block_counts)) as pool:
+        label_maps = np.array(list(pool.map(_bootstrap_label_map, tasks)))
+    return coassignment(label_maps), label_maps
+
+
 @njit(fastmath=True)
 def lightcone_size_2D(depth, c):
     size = 0
@@ -230,10 +1758,20 @@ def extract_lightcones_2D(padded_data, T, Y, X, past_depth, future_depth, c, bas
     future_size = lightcone_size_2D(future_depth, c) - 1
     plcs = np.zeros((T*Y*X, past_size), dtype=dtype)
     flcs = np.zeros((T*Y*X, future_size), dtype=dtype)
+    _extract_lightcone_block_2D(padded_data, 0, T, Y, X, past_depth, future_depth, c, base_anchor, plcs, flcs)
+    return (plcs, flcs)
+
+
+@njit(nogil=True)
+def _extract_lightcone_block_2D(padded_data, t_start, t_stop, Y, X, past_depth, future_depth, c,
+                                base_anchor, plcs, flcs):
+    # fills the rows of plcs and flcs for time steps [t_start, t_stop) of the
+    # extraction region, see extract_lightcones_2D(); releases the GIL, so
+    # blocks of time steps can be extracted concurrently from a thread pool
     base_t, base_y, base_x = base_anchor # reference starting point for spacetime indices
 
-    i = 0
-    for t in range(T):
+    i = t_start*Y*X
+    for t in range(t_start, t_stop):
         for y in range(Y):
             for x in range(X):
                 # loops for past lightcone
@@ -256,9 +1794,128 @@ def extract_lightcones_2D(padded_data, T, Y, X, past_depth, future_depth, c, bas
                             f += 1
                 i += 1
 
+
+def parallel_extract_lightcones_2D(padded_data, T, Y, X, past_depth, future_depth, c, base_anchor, n_workers=None):
+    '''
+    Thread-parallel extract_lightcones_2D(), with the same parameters and
+    return values. Blocks of time steps are extracted concurrently, straight
+    into one shared pair of lightcone arrays, so no per-worker arrays are made
+    or concatenated.
+
+    Parameters
+    ----------
+    n_workers: int, optional (default=None)
+        Number of threads. None uses all cores.
+    '''
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    n_workers = max(1, min(n_workers, T))
+    dtype = padded_data.dtype
+    plcs = np.empty((T*Y*X, lightcone_size_2D(past_depth, c)), dtype=dtype)
+    flcs = np.empty((T*Y*X, lightcone_size_2D(future_depth, c) - 1), dtype=dtype)
+    bounds = (np.arange(n_workers+1) * T) // n_workers
+
+    def extract_block(block):
+        t_start, t_stop = block
+        _extract_lightcone_block_2D(padded_data, t_start, t_stop, Y, X, past_depth, future_depth, c,
+                                    base_anchor, plcs, flcs)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        list(pool.map(extract_block, zip(bounds[:-1], bounds[1:])))
     return (plcs, flcs)
 
 
+@njit(parallel=True)
+def assign_past_lightcones_2D(padded_data, T, Y, X, past_depth, c, base_anchor, weights, centroids):
+    '''
+    Streaming nearest-centroid assignment of past lightcones. Each past lightcone
+    is extracted from the data into a small per-row buffer, weighted, and
+    assigned to the closest (squared Euclidean) past centroid, so the full
+    array of past lightcones is never materialized. Rows of the field are
+    processed in parallel.
+
+    Parameters
+    ----------
+    padded_data: ndarray
+        3D Spacetime array of target data, pre-padded as for extract_lightcones_2D().
+
+    T, Y, X: int
+        Size of the spacetime field minus the margins, as for extract_lightcones_2D().
+
+    past_depth: int
+        Depth of the past lightcones.
+
+    c: int
+        Propagation speed of the spacetime field.
+
+    base_anchor: (int, int, int)
+        Reference spacetime indices, as for extract_lightcones_2D().
+
+    weights: array
+        1D array of weights multiplied onto each flattened past lightcone
+        (e.g. square root of the lightcone decays), applied before assignment.
+
+    centroids: ndarray
+        2D array of past lightcone cluster centroids, one per row.
+
+    Returns
+    -------
+    labels: ndarray
+        (T, Y, X) array of past lightcone cluster labels.
+    '''
+    past_size = lightcone_size_2D(past_depth, c)
+    K = centroids.shape[0]
+    labels = np.empty((T, Y, X), dtype=np.int64)
+    base_t, base_y, base_x = base_anchor
+
+    for ty in prange(T*Y):
+        t = ty // Y
+        y = ty % Y
+        lightcone = np.empty(past_size)
+        for x in range(X):
+            p = 0
+            for d in range(past_depth + 1):
+                for a in range(-d*c, d*c + 1):
+                    for b in range(-d*c, d*c + 1):
+                        lightcone[p] = padded_data[base_t+t-d, base_y+y+a, base_x+x+b] * weights[p]
+                        p += 1
+
+            best = 0
+            best_distance = np.inf
+            for k in range(K):
+                distance = 0.0
+                for i in range(past_size):
+                    diff = lightcone[i] - centroids[k,i]
+                    distance += diff*diff
+                if distance < best_distance:
+                    best_distance = distance
+                    best = k
+            labels[t,y,x] = best
+
+    return labels
+
+
+def state_field_dtype(n_states):
+    '''
+    Returns the smallest unsigned integer dtype that holds the local causal
+    state labels 0,1,...,n_states (uint8 for fewer than 256 states).
+    '''
+    return np.min_scalar_type(n_states)
+
+
+@njit(parallel=True)
+def map_labels(past_field, label_map, out):
+    '''
+    Writes label_map[past_field] into the preallocated array out, which may be
+    a (non-contiguous) view, e.g. the interior of an already padded field.
+    '''
+    T, Y, X = past_field.shape
+    for t in prange(T):
+        for y in range(Y):
+            for x in range(X):
+                out[t,y,x] = label_map[past_field[t,y,x]]
+
+
 @njit
 def past_spatial_decay(depth, c, decay_rate):
     '''
@@ -382,6 +2039,65 @@ def future_spacetime_decay(depth, c, decay_rate):
     decays = np.exp(-distances*decay_rate)
     return decays
 
+def _peak_rss():
+    # peak resident set size of this process so far, in MB (ru_maxrss is in kB
+    # on Linux, bytes on macOS); NaN without the resource module (Windows)
+    if getrusage is None:
+        return np.nan
+    peak = getrusage(RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 1024
+
+
+def _current_rss():
+    # resident set size of this process now, in MB; NaN without /proc (Linux only)
+    if not sys.platform.startswith('linux'):
+        return np.nan
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return np.nan
+
+
+def _telemetry_stage(method):
+    # records the wall time and CPU time (all threads) of a DiscoReconstructor
+    # stage, accumulated over calls, and its memory: the largest increase of
+    # the peak RSS during a call, i.e. how far the stage raised the process's
+    # high-water mark, and the RSS at the end of the last call
+    @wraps(method)
+    def stage(self, *args, **kwargs):
+        if self.telemetry is None:
+            return method(self, *args, **kwargs)
+        wall, cpu, peak = perf_counter(), process_time(), _peak_rss()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            record = self.telemetry.setdefault(method.__name__, [0.0, 0.0, np.nan, np.nan])
+            record[0] += perf_counter() - wall
+            record[1] += process_time() - cpu
+            record[2] = np.fmax(record[2], _peak_rss() - peak) # stays NaN where memory isn't measured
+            record[3] = _current_rss()
+    return stage
+
+
+def stage_completed(completed, stage):
+    '''
+    True if the stage returned by DiscoReconstructor.restore_checkpoint(),
+    completed (None for no checkpoint), includes the given pipeline stage.
+    '''
+    if completed is None:
+        return False
+    return CHECKPOINT_STAGES.index(completed) >= CHECKPOINT_STAGES.index(stage)
+
+
+def _atomic_savez(path, arrays):
+    # writes an .npz file under a temporary name and renames it into place,
+    # so readers never see a partially written file
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(path + '.tmp', path)
+
+
 class DiscoReconstructor(object):
     '''
     Class for handling single-node and distributed local causal state 
@@ -398,7 +2114,8 @@ class DiscoReconstructor(object):
     model.state_field
     '''
 
-    def __init__(self, past_depth, future_depth, propagation_speed, distributed=True):
+    def __init__(self, past_depth, future_depth, propagation_speed, distributed=True, n_workers=1,
+                 telemetry=False):
         '''
         Initialize Reconstructor instance with main inference parameters.
         These define the shape of the lightcone template.
@@ -419,6 +2136,23 @@ class DiscoReconstructor(object):
             Either explicitly specified by the system (like with cellular automata) or
             chosen as an inference parameter to capture specific physics (e.g. chosing
             advection scale rather than accoustic scale for climate).
+
+        distributed: bool, optional (default=True)
+            Whether reconstruction is distributed over MPI ranks.
+
+        n_workers: int, optional (default=1)
+            Number of threads each process uses for lightcone extraction and
+            counting the joint distribution; None uses all cores. Clustering
+            (daal4py) and filtering (numba) are multithreaded regardless. With
+            distributed=False and n_workers=None a single process uses the whole
+            node, without MPI.
+
+        telemetry: bool, optional (default=False)
+            Whether to record the wall time, CPU time and memory use of every
+            stage in DiscoReconstructor.telemetry, as {stage: [wall, cpu, peak
+            RSS increase, RSS after]} (seconds, seconds, MB, MB); see .telemetry_report().
+            The memory values are NaN where they can't be measured: both on
+            Windows, the RSS after a stage everywhere but Linux.
         '''
         # inference params
         self.past_depth = past_depth
@@ -426,9 +2160,12 @@ class DiscoReconstructor(object):
         self.c = propagation_speed
 
         self._distributed = distributed
+        self.n_workers = n_workers
+        self.telemetry = {} if telemetry else None
 
         # for causal clustering and filtering
         self.states = []
+        self.state_table = None
         self.epsilon_map = {}
         self._state_index = 1
 
@@ -438,20 +2175,38 @@ class DiscoReconstructor(object):
 
         # initialize some attributes to None for pipeline fidelity
         self.plcs = None
+        self.pasts = None
         self.target_pasts = None
         self.joint_dist = None
+        self.joint_counts = None
+        self._comparison_cache = None
         self._adjusted_shape = None
-
-    def extract(self, field, boundary_condition='open'):
+        self._bc = None
+        self.label_map = None
+        self.state_stability = None
+        self.coassignment = None
+        self.past_centroids = None
+        self.future_centroids = None
+        self._decay_type = 'none'
+        self._past_decay = 0
+        self._future_decay = 0
+        self._reduce_request = None
+        self.reduce_times = None
+        self._state_buffer = None
+
+    @_telemetry_stage
+    def extract(self, field, boundary_condition='open', time_window=None):
         '''
         Scans target field that is to be filtered after local causal state reconstruction.
         This is the first method that should be run.
 
         Parameters
         ----------
-        field: ndarray
+        field: ndarray or array-like
             2D or 3D array of the target spacetime field. In both cases time should
-            be the zero axis.
+            be the zero axis. May also be a lazily sliced source, such as a
+            memory-mapped .npy file (np.load(path, mmap_mode='r')), an HDF5
+            dataset or a netCDF variable, of which only time_window is read.
 
         boundary_condition: str, optional (default='open')
             Set according to boundary conditions of the target field. Can only be
@@ -459,7 +2214,15 @@ class DiscoReconstructor(object):
             are not collected. Periodic gathers lightcones across the whole spatial
             lattice. Any additional training fields scanned with the .extract_more()
             method will be treated with same boundary conditions specified here.
+
+        time_window: tuple, optional (default=None)
+            (start, stop) time steps of field to extract from, e.g. a rank's
+            (driver.slab.input_start, driver.slab.input_stop) of a source holding
+            the whole run. If None, all of field is used.
         '''
+        if time_window is not None:
+            field = field[time_window[0] : time_window[1]]
+        field = np.asarray(field)
         self._base_anchor = (self.past_depth, self._padding, self._padding)
 
         shape = np.shape(field)
@@ -488,13 +2251,22 @@ class DiscoReconstructor(object):
         self._bc = boundary_condition
 
 
-        self.plcs, self.flcs = extract_lightcones_2D(padded_field, *self._adjusted_shape,
-                                                    self.past_depth,
-                                                    self.future_depth,
-                                                    self.c,
-                                                    self._base_anchor)
+        if self.n_workers == 1:
+            self.plcs, self.flcs = extract_lightcones_2D(padded_field, *self._adjusted_shape,
+                                                        self.past_depth,
+                                                        self.future_depth,
+                                                        self.c,
+                                                        self._base_anchor)
+        else:
+            self.plcs, self.flcs = parallel_extract_lightcones_2D(padded_field, *self._adjusted_shape,
+                                                                 self.past_depth,
+                                                                 self.future_depth,
+                                                                 self.c,
+                                                                 self._base_anchor,
+                                                                 self.n_workers)
 
 
+    @_telemetry_stage
     def kmeans_lightcones(self, past_params, future_params, decay_type='none',
                             past_decay=0, future_decay=0,
                             past_init_params=None, future_init_params=None):
@@ -530,6 +2302,9 @@ class DiscoReconstructor(object):
 
         if decay_type not in ['space', 'time', 'spacetime', 'none']:
             raise ValueError("decay_type must be 'none', 'space', 'time', or 'spacetime'")
+        self._decay_type = decay_type
+        self._past_decay = past_decay
+        self._future_decay = future_decay
             
         if decay_type == 'space':
             past_decays = past_spatial_decay(self.past_depth, self.c, past_decay)
@@ -563,6 +2338,7 @@ class DiscoReconstructor(object):
         past_cluster = d4p.kmeans(distributed=self._distributed, **past_params).compute(self.plcs, centroids)
         past_local = d4p.kmeans(nClusters=self._N_pasts, distributed=False, assignFlag=True, maxIterations=0).compute(self.plcs, past_cluster.centroids)
         self.pasts = past_local.assignments.flatten()
+        self.past_centroids = np.asarray(past_cluster.centroids)
      
         del past_cluster 
         del self.plcs 
@@ -581,32 +2357,121 @@ class DiscoReconstructor(object):
         future_cluster = d4p.kmeans(distributed=self._distributed, **future_params).compute(self.flcs, centroids)
         future_local = d4p.kmeans(nClusters=self._N_futures, distributed=False, assignFlag=True, maxIterations=0).compute(self.flcs, future_cluster.centroids)
         self.futures = future_local.assignments.flatten()
+        self.future_centroids = np.asarray(future_cluster.centroids)
 
         del future_cluster
         del self.flcs 
 
 
-    def reconstruct_morphs(self):
+    @_telemetry_stage
+    def reconstruct_morphs(self, sparse=False, time_block=None):
         '''
         Counts lightcone cluster labels to build empirical joint distribution.
+
+        Parameters
+        ----------
+        sparse: bool, optional (default=False)
+            Keep the joint distribution as a scipy.sparse CSR matrix, for large
+            numbers of pasts and futures where most (past, future) pairs are never
+            observed. Distributed runs must then use .reduce_morphs() rather than
+            a hand-written Allreduce.
+
+        time_block: int, optional (default=None)
+            If given, also keep the joint counts of each block of time_block time
+            steps in DiscoReconstructor.block_counts, an array of shape
+            (n_blocks, N_pasts, N_futures), or with sparse=True a list of one
+            CSR matrix per block, for block bootstrapping (see .bootstrap_states()).
         '''
         if self.pasts is None:
             raise RuntimeError("Must call .cluster_lightcones() before calling .reconstruct_morphs()")
         # morphs accessed through this joint distribution over pasts and futures
-        self.local_joint_dist = dist_from_data(self.pasts, self.futures, self._N_pasts, self._N_futures)#, row_labels=True)
-        if self._distributed:
+        self.joint_counts = JointCounts(self._N_pasts, self._N_futures, sparse=sparse)
+        self.joint_counts.update(self.pasts, self.futures, n_workers=self.n_workers)
+        self.local_joint_dist = self.joint_counts.counts
+
+        if time_block is not None:
+            # labels are ordered time first, so each block of time steps is contiguous
+            T, Y, X = self._adjusted_shape
+            step = time_block*Y*X
+            blocks = [dist_from_data(self.pasts[start:start+step], self.futures[start:start+step],
+                                     self._N_pasts, self._N_futures, sparse=sparse)
+                          for start in range(0, T*Y*X, step)]
+            self.block_counts = blocks if sparse else np.stack(blocks)
+        if self._distributed and not sparse:
             self.global_joint_dist = np.zeros((self._N_pasts, self._N_futures), dtype=np.uint64)
 
         del self.futures
 
+    @_telemetry_stage
+    def reduce_morphs(self, comm, blocking=True, node_comms=None):
+        '''
+        Sums the local joint distributions of all ranks of the given mpi4py
+        communicator into DiscoReconstructor.global_joint_dist. Equivalent to
+        comm.Allreduce(local_joint_dist, global_joint_dist, op=MPI.SUM), but
+        also handles sparse joint distributions.
+
+        With blocking=False the reduction is only started (an Iallreduce), so
+        independent work such as .prepare_filter() can run while it is in
+        flight. Methods that need the global joint distribution wait for it to
+        complete, see .wait_morphs().
+
+        In hybrid runs with several ranks per node, pass the NodeComms of comm
+        (see split_node_comms() and DiscoDriver.setup_hybrid()) to sum on each
+        node first, so only node leaders take part in the inter-node reduction.
+        '''
+        if self.joint_counts is None:
+            raise RuntimeError("Must call .reconstruct_morphs() before calling .reduce_morphs()")
+        if blocking and node_comms is None:
+            self.global_joint_counts = self.joint_counts.allreduce(comm)
+        elif blocking:
+            self.global_joint_counts = self.joint_counts.node_allreduce(node_comms)
+        else:
+            if node_comms is None:
+                self._reduce_request, self.global_joint_counts = self.joint_counts.iallreduce(comm)
+            else:
+                self._reduce_request, self.global_joint_counts = self.joint_counts.node_iallreduce(node_comms)
+            self._reduce_start = perf_counter()
+        self.global_joint_dist = self.global_joint_counts.counts
+
+    def wait_morphs(self):
+        '''
+        Completes a non-blocking .reduce_morphs(), if one is in flight, and keeps
+        its timing in DiscoReconstructor.reduce_times, a ReduceTimes of
+
+        in_flight: seconds of other work done after the reduction was started
+        waited: seconds then spent completing it
+        completed: whether it had already completed when tested before waiting
+            (in hybrid runs, the reduction over node leaders, on the leaders)
 
+        The in-flight time is just the time the other work took: the reduction
+        was hidden behind it only if it completed, and otherwise the waited time
+        is what it still cost. Compare with the time of a blocking reduction.
+        '''
+        if self._reduce_request is None:
+            return
+        in_flight = perf_counter() - self._reduce_start
+        completed = self._reduce_request.Test()
+        self._reduce_request.Wait()
+        self.reduce_times = ReduceTimes(in_flight, perf_counter() - self._reduce_start - in_flight, completed)
+        self._reduce_request = None
+
+    def _morph_dist(self):
+        # joint distribution the morphs are taken from
+        if self._distributed:
+            self.wait_morphs()
+            return self.global_joint_dist
+        return self.local_joint_dist
+
+    @_telemetry_stage
     def reconstruct_states(self, metric, *metric_args, pval_threshold=0.05, **metric_kwargs):
         '''
         Hierarchical agglomerative clustering of lightcone morphs
-        from a given joint distribution array (joint over lightcone clusters),
-        where the first column is the labels for the plc clusters (pasts).
-        This is needed because a random permutation should be done before
-        clustering.
+        from the joint distribution array (joint over lightcone clusters),
+        see reconstruct_causal_states(). The states are kept in
+        DiscoReconstructor.state_table, with CausalState views onto it in
+        DiscoReconstructor.states. Pasts are clustered in label order; as the
+        greedy agglomeration depends on this order, .reconstruct_states_ensemble()
+        instead keeps the consensus of many random orderings.
 
         Any noise clusters are ignored. If there is a noise cluster for pasts,
         it is assigned to the NAN state. If there is a noise cluster for futures,
@@ -617,74 +2482,1357 @@ class DiscoReconstructor(object):
         metric: function
             Python function that does a stastical comparison of two empirical distributions.
             In the current use, this function is expected to return a p value for this
-            comparison.
+            comparison. If the function has a batched counterpart (see register_batch_metric()),
+            that is used instead to compare each past against all current states in a
+            single call.
 
         pval_threshold: float, optional (default=0.05)
             p value threshold for the distribution comparison. If the comparison p
             value is greater than pval_threshold, the two distributions are considered
-            equivalent.
+            equivalent. For distance metrics (hellinger, jensen_shannon, total_variation,
+            kl_divergence) this is instead the distance below which the two
+            distributions are considered equivalent.
+
+        '''
+        joint_dist = self._morph_dist()
+
+        # hierarchical agglomerative clustering -- clusters pasts into local causal states
+        self.state_table, self.label_map = reconstruct_causal_states(joint_dist, metric, *metric_args,
+                                                                     pval_threshold=pval_threshold,
+                                                                     **metric_kwargs)
+        self.states = self.state_table.states()
+        self._state_index = self.state_table.n_states + 1
+        self.epsilon_map = {past : self.states[row]
+                                for past, row in enumerate(self.state_table.past_states)}
+
+        del self.joint_dist
+
+    @_telemetry_stage
+    def reconstruct_states_ensemble(self, metric, *metric_args, pval_threshold=0.05, n_permutations=32,
+                                    n_workers=None, seed=0, processes=None, **metric_kwargs):
+        '''
+        Order-robust alternative to .reconstruct_states(). Reconstructs local causal
+        states for n_permutations random orderings of the pasts in parallel (see
+        permutation_ensemble()) and keeps their consensus (see consensus_states())
+        as DiscoReconstructor.label_map, with the matching state_table and states.
+
+        Per-past stability scores are kept in DiscoReconstructor.state_stability,
+        and saved with the model, and the pairwise co-assignment frequencies in
+        DiscoReconstructor.coassignment. With chi_squared the orderings are
+        clustered by a compiled kernel in threads (see permutation_ensemble()),
+        cheap enough for the run scripts to use this in place of .reconstruct_states().
+
+        The seed must be the same on every rank of a distributed run.
+        '''
+        joint_dist = self._morph_dist()
+
+        label_maps = permutation_ensemble(joint_dist, metric, *metric_args,
+                                          pval_threshold=pval_threshold,
+                                          n_permutations=n_permutations,
+                                          n_workers=n_workers, seed=seed, processes=processes,
+                                          **metric_kwargs)
+        self.label_map, self.state_stability, self.coassignment = consensus_states(label_maps)
+        self.state_table = state_table_from_labels(joint_dist, self.label_map)
+        self.states = self.state_table.states()
+        self._state_index = self.state_table.n_states + 1
+        self.epsilon_map = {past : self.states[row]
+                                for past, row in enumerate(self.state_table.past_states)}
+
+    def update_states(self, pasts, count_deltas, metric, *metric_args, pval_threshold=0.05, **metric_kwargs):
+        '''
+        Online update of the local causal states for new counts of the given pasts,
+        without re-running .reconstruct_states() over the whole joint distribution.
+        Only the given pasts are re-tested; see update_causal_states().
+
+        In distributed runs the deltas should already be summed over ranks, and be
+        the same on every rank, as they are added to DiscoReconstructor.global_joint_dist.
+
+        Parameters
+        ----------
+        pasts: array-like
+            Labels of the pasts with new counts.
+
+        count_deltas: array-like
+            (len(pasts), N_futures) array of counts to add to the morph of each past.
+
+        metric: function
+            Distribution comparison function, as used for .reconstruct_states().
 
+        pval_threshold: float, optional (default=0.05)
+            Threshold for the distribution comparison.
+
+        Returns
+        -------
+        relabeled: dict
+            {past: (old_label, new_label)} for every past whose state changed.
+            The label_map is updated accordingly.
+
+        removed: list
+            Labels of the states left empty by the update, which are dropped
+            from DiscoReconstructor.states.
         '''
-       
-        # create past labels to keep track of after random permutation
-        rlabels = np.arange(0, self._N_pasts, dtype=np.uint64)[np.newaxis] 
-        # self.global_joint_dist = np.hstack((rlabels.T, self.global_joint_dist))
-        # morphs = self.global_joint_dist
+        if self.state_table is None:
+            raise RuntimeError("Must call .reconstruct_states() before calling .update_states()")
+
+        joint_dist, relabeled, removed = update_causal_states(self.state_table, self.label_map, self._morph_dist(),
+                                                     pasts, count_deltas, metric, *metric_args,
+                                                     pval_threshold=pval_threshold, **metric_kwargs)
         if self._distributed:
-            morphs = np.hstack((rlabels.T, self.global_joint_dist))
+            self.global_joint_dist = joint_dist
         else:
-            morphs = np.hstack((rlabels.T, self.local_joint_dist))
-
-        self.label_map = np.zeros(self._N_pasts, dtype=int) # for vectorized causal_filter
+            self.local_joint_dist = joint_dist
+        # morphs changed, so cached comparisons are stale
+        self._comparison_cache = None
+
+        self.states = self.state_table.states()
+        self._state_index = self.state_table.n_states + 1
+        if removed:
+            # dropping states moves the rows after them, which all views refer to
+            self.epsilon_map = {past : self.states[row]
+                                    for past, row in enumerate(self.state_table.past_states)}
+        else:
+            for past in relabeled:
+                self.epsilon_map[past] = self.states[self.state_table.past_states[past]]
+        return relabeled, removed
 
-        # hierarchical agglomerative clustering -- clusters pasts into local causal states
-        for item in morphs:
-            past = item[0]
-            morph = item[1:]
-            for state in self.states:
-                p_value = metric(morph, state.morph, *metric_args, **metric_kwargs)
-                if p_value > pval_threshold:
-                    state.update(past, morph)
-                    self.epsilon_map.update({past : state})
-                    self.label_map[past] = state.index
-                    break
+    def bootstrap_states(self, metric, *metric_args, pval_threshold=0.05, n_replicates=100,
+                         method='multinomial', comm=None, root=0, n_workers=None, seed=0, processes=True,
+                         **metric_kwargs):
+        '''
+        Bootstrap uncertainty of the local causal states, see bootstrap_states().
+        The co-assignment frequencies of all pairs of pasts are returned and kept
+        in DiscoReconstructor.bootstrap_coassignment.
+
+        For method='block', the time blocks are those kept by
+        .reconstruct_morphs(time_block=...). In distributed runs pass the mpi4py
+        communicator as comm: the blocks of all ranks are then gathered on rank
+        root, which alone runs the bootstrap, and the other ranks return None.
+        '''
+        block_counts = None
+        if method == 'block':
+            if getattr(self, 'block_counts', None) is None:
+                raise RuntimeError("Must call .reconstruct_morphs(time_block=...) for method='block'")
+            block_counts = self.block_counts
+            if comm is not None:
+                block_counts = comm.gather(block_counts, root=root)
+                if block_counts is not None:
+                    block_counts = list(chain.from_iterable(block_counts))
+        if comm is not None and comm.Get_rank() != root:
+            self.bootstrap_coassignment = None
+            return None
+
+        self.bootstrap_coassignment, _ = bootstrap_states(self._morph_dist(), metric, *metric_args,
+                                                          pval_threshold=pval_threshold,
+                                                          n_replicates=n_replicates,
+                                                          method=method,
+                                                          block_counts=block_counts,
+                                                          n_workers=n_workers,
+                                                          seed=seed,
+                                                          processes=processes,
+                                                          **metric_kwargs)
+        return self.bootstrap_coassignment
+
+    def sweep_thresholds(self, metric, thresholds, *metric_args, **metric_kwargs):
+        '''
+        Reconstructs local causal states for each of the given p value thresholds
+        in one call, from the same joint distribution used by .reconstruct_states().
+        Metric comparisons are cached on the instance (see MorphComparisonCache),
+        so further sweeps with the same metric only pay for comparisons not seen
+        before.
+
+        Does not change the states or label_map of the instance; run
+        .reconstruct_states() with the chosen threshold for filtering.
+
+        Returns
+        -------
+        label_maps: ndarray
+            Integer array of shape (len(thresholds), N_pasts), one label_map per threshold.
+
+        n_states: ndarray
+            Number of local causal states reconstructed for each threshold.
+        '''
+        joint_dist = self._morph_dist()
 
-            else:
-                new_state = CausalState(self._state_index, past, morph)
-                self.states.append(new_state)
-                self._state_index += 1
-                self.epsilon_map.update({past : new_state})
-                self.label_map[past] = new_state.index
+        cache = self._comparison_cache
+        if (cache is None or cache.morphs is not joint_dist or cache.metric is not metric
+                or cache.metric_args != metric_args or cache.metric_kwargs != metric_kwargs):
+            cache = MorphComparisonCache(joint_dist, metric, *metric_args, **metric_kwargs)
+            self._comparison_cache = cache
 
-        del self.joint_dist
+        return sweep_states(joint_dist, metric, thresholds, cache=cache)
 
-    def causal_filter(self):
+    @_telemetry_stage
+    def causal_filter(self, dtype=None):
         '''
         Performs causal filtering on target field (input for Reconstructor.extract())
         and creats associated local causal state field (Reconstructor.state_field)
 
         The margins, spacetime points that don't have a full past or future lightcone,
         are assigned the NAN state with integer label 0.
+
+        Parameters
+        ----------
+        dtype: numpy dtype, optional (default=None)
+            dtype of the state field. Defaults to the smallest unsigned integer type
+            that holds all state labels (see state_field_dtype()), e.g. uint8.
         '''
         # OPT: comment out for peformance runs
         if len(self.states) == 0:
             raise RuntimeError("Must call .reconstruct_states() first.")
 
         past_field = self.pasts.reshape(*self._adjusted_shape)
-        self.state_field = np.zeros(self._adjusted_shape, dtype=int)
-
-        # use label_map to map past_field to field of local causal state labels
-        self.state_field = self.label_map[past_field]
 
-        # Go back and re-pad state field with margin so it is the same shape as the original data
+        # re-pad state field with margin so it is the same shape as the original data
         if self._bc == 'open':
             spatial_pad = self._padding
         elif self._bc == 'periodic':
             spatial_pad = 0
 
-        margin_padding = (
-                            (0, 0), # don't re-pad temporal margin; taken care of w/ haloing
-                            (spatial_pad, spatial_pad),
-                            (spatial_pad, spatial_pad)
-                        )
-        self.state_field = np.pad(self.state_field, margin_padding, 'constant')
+        # don't re-pad temporal margin; taken care of w/ haloing
+        out = None
+        if self._state_buffer is not None and (dtype is None or np.dtype(dtype) == self._state_buffer.dtype):
+            out, self._state_buffer = self._state_buffer, None
+        self.state_field = self._state_field(past_field, spatial_pad, dtype, out)
+
+    @_telemetry_stage
+    def prepare_filter(self, dtype=None):
+        '''
+        Allocates (and touches) the state field that .causal_filter() writes
+        into, and compiles the label mapping kernel for it. None of this needs
+        the local causal states, so it can run while a non-blocking
+        .reduce_morphs() is in flight.
+
+        Parameters
+        ----------
+        dtype: numpy dtype, optional (default=None)
+            dtype of the state field. As the number of states is not yet known,
+            defaults to the smallest unsigned integer type that holds a label
+            for every past, the most states there can be.
+        '''
+        if self.pasts is None:
+            raise RuntimeError("Must call .kmeans_lightcones() before calling .prepare_filter()")
+        if dtype is None:
+            dtype = state_field_dtype(self._N_pasts)
+        T, Y, X = self._adjusted_shape
+        spatial_pad = self._padding if self._bc == 'open' else 0
+        buffer = np.empty((T, Y + 2*spatial_pad, X + 2*spatial_pad), dtype=dtype)
+        buffer.fill(0) # fault the pages in now rather than during filtering
+        past_field = self.pasts.reshape(*self._adjusted_shape)
+        # compile for the (strided, with open boundaries) interior view that
+        # ._state_field() writes into; two time steps keep its memory layout
+        interior = buffer[:, spatial_pad:spatial_pad+Y, spatial_pad:spatial_pad+X]
+        map_labels(past_field[:2], np.zeros(self._N_pasts, dtype=dtype), interior[:2])
+        self._state_buffer = buffer
+
+    def _state_field(self, past_field, spatial_pad, dtype=None, out=None):
+        # maps past labels to local causal state labels, written straight into a
+        # preallocated field of the smallest sufficient dtype that already has the
+        # (zero, i.e. NAN state) spatial margin
+        if out is not None:
+            dtype = out.dtype
+            if np.max(self.label_map) > np.iinfo(dtype).max:
+                raise ValueError("State labels do not fit in the prepared {} state field".format(dtype))
+        elif dtype is None:
+            dtype = state_field_dtype(np.max(self.label_map))
+        T, Y, X = past_field.shape
+        if out is None:
+            state_field = np.zeros((T, Y + 2*spatial_pad, X + 2*spatial_pad), dtype=dtype)
+        else:
+            state_field = out
+        interior = state_field[:, spatial_pad:spatial_pad+Y, spatial_pad:spatial_pad+X]
+        map_labels(past_field, self.label_map.astype(dtype), interior)
+        return state_field
+
+    def _past_weights(self):
+        # weights applied to past lightcones before clustering, from the decay configuration
+        if self._decay_type == 'space':
+            past_decays = past_spatial_decay(self.past_depth, self.c, self._past_decay)
+        elif self._decay_type == 'time':
+            past_decays = past_temporal_decay(self.past_depth, self.c, self._past_decay)
+        elif self._decay_type == 'spacetime':
+            past_decays = past_spacetime_decay(self.past_depth, self.c, self._past_decay)
+        else:
+            past_decays = np.ones(lightcone_size_2D(self.past_depth, self.c))
+        return np.sqrt(past_decays)
+
+    def filter(self, field, boundary_condition=None, dtype=None):
+        '''
+        Inference-only causal filtering of a new field with the trained (or loaded)
+        model. Only past lightcones are needed: they are extracted and assigned to
+        the stored past centroids in a single streaming pass (see
+        assign_past_lightcones_2D()), then mapped to local causal states through
+        label_map. No k-means or morph reconstruction is rerun.
+
+        The decay configuration used for training is applied to the new past
+        lightcones. Pipelines that transform lightcones by hand before
+        .kmeans_lightcones() (e.g. the multivariate climate scripts) are not
+        reproduced here.
+
+        Parameters
+        ----------
+        field: ndarray
+            3D array of the new spacetime field, with time on axis 0.
+
+        boundary_condition: str, optional (default=None)
+            'open' or 'periodic'. Defaults to the boundary condition used for training.
+
+        dtype: numpy dtype, optional (default=None)
+            dtype of the state field, as for .causal_filter().
+
+        Returns
+        -------
+        state_field: ndarray
+            Local causal state field. As only past lightcones are needed, it
+            covers time steps past_depth to T-1 of the input (no future margin).
+            Spatial margins for open boundaries are assigned the NAN state 0,
+            as with .causal_filter().
+        '''
+        if self.label_map is None or self.past_centroids is None:
+            raise RuntimeError("Must reconstruct states (or .load() a model) before calling .filter()")
+        if boundary_condition is None:
+            boundary_condition = self._bc
+
+        shape = np.shape(field)
+        if len(shape) != 3:
+            raise ValueError("Input field must be 3 dimensions")
+
+        T, Y, X = shape
+        adjusted_T = T - self.past_depth # no future lightcones, so only a past time margin
+        if boundary_condition == 'open':
+            adjusted_Y = Y - 2*self._padding
+            adjusted_X = X - 2*self._padding
+            padded_field = np.asarray(field)
+        elif boundary_condition == 'periodic':
+            adjusted_Y = Y
+            adjusted_X = X
+            padded_field = np.pad(field,
+                                  (
+                                      (0,0),
+                                      (self._padding, self._padding),
+                                      (self._padding, self._padding)
+                                  ),
+                                  'wrap')
+        else:
+            raise ValueError("boundary_condition must be either 'open' or 'periodic'.")
+
+        base_anchor = (self.past_depth, self._padding, self._padding)
+        past_field = assign_past_lightcones_2D(padded_field, adjusted_T, adjusted_Y, adjusted_X,
+                                               self.past_depth,
+                                               self.c,
+                                               base_anchor,
+                                               self._past_weights(),
+                                               np.ascontiguousarray(self.past_centroids, dtype=np.float64))
+
+        spatial_pad = self._padding if boundary_condition == 'open' else 0
+        return self._state_field(past_field, spatial_pad, dtype)
+
+    def save(self, path):
+        '''
+        Saves the trained model -- lightcone template and decay configuration,
+        lightcone cluster centroids, joint distribution, local causal states, and
+        label_map -- to a single versioned .npz file, which DiscoReconstructor.load()
+        reads back for inference on new fields. In distributed runs every rank
+        holds the same model, so only one rank needs to save it.
+        '''
+        if self.label_map is None:
+            raise RuntimeError("Must call .reconstruct_states() before calling .save()")
+        np.savez(path, **self._model_arrays())
+
+    def _model_arrays(self, joint=True, states=True):
+        # versioned arrays of the model, shared by all ranks, as far as it has
+        # been trained: template and decays, centroids, and optionally the
+        # (global) joint distribution and the local causal states
+        model = {
+            'format_version': MODEL_FORMAT_VERSION,
+            'past_depth': self.past_depth,
+            'future_depth': self.future_depth,
+            'propagation_speed': self.c,
+            'boundary_condition': '' if self._bc is None else self._bc,
+            'decay_type': self._decay_type,
+            'past_decay': self._past_decay,
+            'future_decay': self._future_decay,
+            'N_pasts': self._N_pasts,
+            'N_futures': self._N_futures,
+        }
+        if self.past_centroids is not None:
+            model['past_centroids'] = self.past_centroids
+        if self.future_centroids is not None:
+            model['future_centroids'] = self.future_centroids
+
+        if states:
+            table = self.state_table
+            n_states = table.n_states
+            model['label_map'] = self.label_map
+            model['state_indices'] = table.indices[:n_states]
+            model['state_counts'] = table.counts[:n_states]
+            model['state_n_pasts'] = table.n_pasts[:n_states]
+            model['past_states'] = table.past_states
+            if self.state_stability is not None:
+                model['state_stability'] = self.state_stability
+
+        if joint:
+            joint_dist = self._morph_dist()
+            if issparse(joint_dist):
+                joint_dist = csr_matrix(joint_dist)
+                model['joint_data'] = joint_dist.data
+                model['joint_indices'] = joint_dist.indices
+                model['joint_indptr'] = joint_dist.indptr
+            else:
+                model['joint_dist'] = joint_dist
+        return model
+
+    @classmethod
+    def load(cls, path, distributed=False):
+        '''
+        Loads a model written by DiscoReconstructor.save(). The returned
+        DiscoReconstructor has its states and label_map in place, ready to
+        segment new fields with .filter().
+
+        Parameters
+        ----------
+        path: str
+            Path to the saved .npz model file.
+
+        distributed: bool, optional (default=False)
+            distributed flag of the returned instance.
+        '''
+        with np.load(path) as model:
+            recon = cls(int(model['past_depth']),
+                        int(model['future_depth']),
+                        int(model['propagation_speed']),
+                        distributed=distributed)
+            recon._restore_model(model)
+        return recon
+
+    def _restore_model(self, model):
+        # inverse of ._model_arrays(), for whichever parts the file holds
+        version = int(model['format_version'])
+        if version > MODEL_FORMAT_VERSION:
+            raise ValueError("Model file format version {} is newer than the supported version {}".format(
+                                version, MODEL_FORMAT_VERSION))
+
+        self._bc = str(model['boundary_condition']) or None
+        self._decay_type = str(model['decay_type'])
+        self._past_decay = float(model['past_decay'])
+        self._future_decay = float(model['future_decay'])
+        self._N_pasts = int(model['N_pasts'])
+        self._N_futures = int(model['N_futures'])
+        if 'past_centroids' in model:
+            self.past_centroids = model['past_centroids']
+        if 'future_centroids' in model:
+            self.future_centroids = model['future_centroids']
+
+        if 'joint_dist' in model or 'joint_data' in model:
+            if 'joint_dist' in model:
+                joint_dist = model['joint_dist']
+            else:
+                joint_dist = csr_matrix((model['joint_data'], model['joint_indices'], model['joint_indptr']),
+                                        shape=(self._N_pasts, self._N_futures))
+            self.joint_counts = JointCounts(self._N_pasts, self._N_futures, joint_dist)
+            self.local_joint_dist = self.joint_counts.counts
+            if self._distributed:
+                self.global_joint_counts = self.joint_counts
+                self.global_joint_dist = self.local_joint_dist
+
+        if 'label_map' in model:
+            self.label_map = model['label_map']
+            self.state_table = CausalStateTable.from_arrays(model['state_indices'],
+                                                            model['state_counts'],
+                                                            model['state_n_pasts'],
+                                                            model['past_states'])
+            self.states = self.state_table.states()
+            self._state_index = self.state_table.n_states + 1
+            self.epsilon_map = {past : self.states[row]
+                                    for past, row in enumerate(self.state_table.past_states)}
+            if 'state_stability' in model:
+                self.state_stability = model['state_stability']
+
+    @_telemetry_stage
+    def checkpoint(self, directory, stage, comm=None):
+        '''
+        Writes a checkpoint at a stage boundary of the pipeline, which
+        .restore_checkpoint() resumes from after a failure or timeout. Call on
+        all ranks right after the stage:
+
+        'cluster': after .kmeans_lightcones() -- each rank's past and future labels
+            and the centroids.
+        'morphs': after .reduce_morphs() (or .reconstruct_morphs() when not
+            distributed) -- each rank's past labels and the global joint distribution.
+        'states': after .reconstruct_states() -- as for 'morphs', plus the local
+            causal states and label_map.
+
+        Every rank writes its own labels file, in parallel, and rank 0 the
+        shared model file; a manifest naming the completed stage is written
+        last. All files are written to a temporary name and atomically renamed,
+        so a job killed mid-checkpoint leaves the previous checkpoint intact.
+
+        Parameters
+        ----------
+        directory: str
+            Checkpoint directory, shared by all ranks.
+
+        stage: str
+            One of CHECKPOINT_STAGES.
+
+        comm: mpi4py communicator, optional (default=None)
+            Communicator of a distributed run.
+        '''
+        if stage not in CHECKPOINT_STAGES:
+            raise ValueError("stage must be one of {}".format(CHECKPOINT_STAGES))
+        rank = 0 if comm is None else comm.Get_rank()
+        size = 1 if comm is None else comm.Get_size()
+        os.makedirs(directory, exist_ok=True)
+
+        labels = {'pasts': self.pasts,
+                  'adjusted_shape': np.array(self._adjusted_shape),
+                  'boundary_condition': '' if self._bc is None else self._bc}
+        if stage == 'cluster':
+            labels['futures'] = self.futures
+        _atomic_savez(os.path.join(directory, '{}-rank-{:05d}.npz'.format(stage, rank)), labels)
+
+        # the model is the same on every rank; collectives inside ._morph_dist()
+        # have completed everywhere by the time rank 0 writes it
+        model = self._model_arrays(joint=stage != 'cluster', states=stage == 'states')
+        if rank == 0:
+            _atomic_savez(os.path.join(directory, '{}-model.npz'.format(stage)), model)
+
+        if comm is not None:
+            comm.Barrier() # every rank's files are complete before the manifest names the stage
+        if rank == 0:
+            manifest = os.path.join(directory, 'checkpoint.json')
+            with open(manifest + '.tmp', 'w') as f:
+                json.dump({'stage': stage, 'n_ranks': size, 'format_version': MODEL_FORMAT_VERSION}, f)
+            os.replace(manifest + '.tmp', manifest)
+
+    def restore_checkpoint(self, directory, comm=None, n_clusters=None):
+        '''
+        Restores this rank's part of the latest checkpoint written by
+        .checkpoint() in directory, if there is one, so a resubmitted job can
+        skip the completed stages (see stage_completed()). The run must use the
+        same number of ranks and decomposition as the one that wrote it, and
+        the same lightcone depths and propagation speed as this instance;
+        otherwise a ValueError is raised.
+
+        Parameters
+        ----------
+        directory: str
+            Checkpoint directory, shared by all ranks.
+
+        comm: mpi4py communicator, optional (default=None)
+            Communicator of a distributed run.
+
+        n_clusters: tuple, optional (default=None)
+            (past, future) numbers of clusters the run's .kmeans_lightcones()
+            uses. If given, the checkpoint must have been clustered with them.
+
+        Returns
+        -------
+        stage: str or None
+            The completed stage restored, or None if there is no checkpoint.
+        '''
+        rank = 0 if comm is None else comm.Get_rank()
+        size = 1 if comm is None else comm.Get_size()
+        manifest = os.path.join(directory, 'checkpoint.json')
+        if rank == 0:
+            info = None
+            if os.path.exists(manifest):
+                with open(manifest) as f:
+                    info = json.load(f)
+        if comm is not None:
+            info = comm.bcast(info if rank == 0 else None, root=0)
+        if info is None:
+            return None
+        if info['n_ranks'] != size:
+            raise ValueError("Checkpoint was written by {} ranks, not {}".format(info['n_ranks'], size))
+
+        stage = info['stage']
+        with np.load(os.path.join(directory, '{}-model.npz'.format(stage))) as model:
+            expected = {'past_depth': self.past_depth,
+                        'future_depth': self.future_depth,
+                        'propagation_speed': self.c}
+            if n_clusters is not None:
+                expected['N_pasts'], expected['N_futures'] = n_clusters
+            for name, value in expected.items():
+                if int(model[name]) != value:
+                    raise ValueError("Checkpoint was written with {} {}, not {}".format(name, int(model[name]), value))
+            self._restore_model(model)
+        with np.load(os.path.join(directory, '{}-rank-{:05d}.npz'.format(stage, rank))) as labels:
+            self.pasts = labels['pasts']
+            self._adjusted_shape = tuple(int(n) for n in labels['adjusted_shape'])
+            self._bc = str(labels['boundary_condition']) or None
+            if 'futures' in labels:
+                self.futures = labels['futures']
+        self.plcs = None
+        self.flcs = None
+        return stage
+
+    def telemetry_report(self, comm=None, path=None, straggler_factor=1.5, min_straggler_time=1.0, root=0):
+        '''
+        Gathers the stage telemetry of all ranks to root and summarizes it: the
+        min/median/max over ranks of each stage's wall time, CPU time, increase
+        of the peak RSS and RSS at its end, its slowest rank and node, and its
+        straggler ranks, whose wall time exceeds straggler_factor times the
+        median and min_straggler_time. Call on all ranks of a run whose
+        DiscoReconstructor was created with telemetry=True.
+
+        Parameters
+        ----------
+        comm: mpi4py communicator, optional (default=None)
+            Communicator of a distributed run.
+
+        path: str, optional (default=None)
+            File root writes the summary to, if given.
+
+        straggler_factor: float, optional (default=1.5)
+            Multiple of the median wall time beyond which a rank is a straggler.
+
+        min_straggler_time: float, optional (default=1.0)
+            Seconds of wall time below which a rank is never a straggler, so
+            that short stages are not flagged for noise.
+
+        root: int, optional (default=0)
+            Rank the telemetry is gathered to.
+
+        Returns
+        -------
+        summary: str or None
+            The summary on root, None on the other ranks.
+        '''
+        if self.telemetry is None:
+            raise RuntimeError("Must create the DiscoReconstructor with telemetry=True to report telemetry")
+        record = (socket.gethostname(), self.telemetry)
+        if comm is None:
+            records = [record]
+        else:
+            records = comm.gather(record, root=root)
+            if comm.Get_rank() != root:
+                return None
+
+        # stages in the order they ran, including any run on only some ranks
+        stages = list(dict.fromkeys(stage for _, telemetry in records for stage in telemetry))
+        lines = ['{} ranks on {} nodes'.format(len(records), len(set(host for host, _ in records))),
+                 '{:<28}{:>26}{:>26}{:>32}{:>32}  {}'.format('stage', 'wall min/med/max (s)', 'CPU min/med/max (s)',
+                                                            'peak RSS rise min/med/max (MB)', 'RSS after min/med/max (MB)',
+                                                            'slowest rank, stragglers')]
+        for stage in stages:
+            ranks = [rank for rank, (_, telemetry) in enumerate(records) if stage in telemetry]
+            values = np.array([records[rank][1][stage] for rank in ranks])
+            wall = values[:, 0]
+            slowest = ranks[np.argmax(wall)]
+            stragglers = [rank for rank, seconds in zip(ranks, wall)
+                              if seconds > max(straggler_factor*np.median(wall), min_straggler_time)]
+            columns = ['{:.2f}/{:.2f}/{:.2f}'.format(*np.percentile(values[:, i], [0, 50, 100])) for i in range(4)]
+            lines.append('{:<28}{:>26}{:>26}{:>32}{:>32}  {} ({}), {}'.format(stage, *columns, slowest,
+                                                                            records[slowest][0], stragglers))
+        summary = '\n'.join(lines)
+
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(summary + '\n')
+        return summary
+
+
+# time steps of one rank's slab of a distributed run: the rank produces states
+# for global steps [start, stop) and reads steps [input_start, input_stop), i.e.
+# its owned steps plus past_depth and future_depth halo steps on either side
+TimeSlab = namedtuple('TimeSlab', ['start', 'stop', 'input_start', 'input_stop'])
+
+
+def partition_time(n_steps, past_depth, future_depth, n_ranks, start=None, stop=None):
+    '''
+    Splits the time steps of a field with n_steps time steps, that have full
+    past and future lightcones, evenly over n_ranks ranks. Slab sizes differ by
+    at most one time step, and any number of ranks up to the number of steps
+    is supported.
+
+    Parameters
+    ----------
+    n_steps: int
+        Total number of time steps of the field.
+
+    past_depth, future_depth: int
+        Lightcone depths; these set the halo steps each slab must read.
+
+    n_ranks: int
+        Number of slabs to split into.
+
+    start, stop: int, optional (default=None)
+        Restrict the output to global time steps [start, stop). Defaults to all
+        time steps with full lightcones, [past_depth, n_steps - future_depth).
+
+    Returns
+    -------
+    slabs: list
+        One TimeSlab per rank, in rank order.
+    '''
+    first = past_depth if start is None else start
+    last = n_steps - future_depth if stop is None else stop
+    if first < past_depth or last > n_steps - future_depth:
+        raise ValueError("Output steps [{}, {}) need lightcones outside of the {} available time steps".format(
+                            first, last, n_steps))
+    n_valid = last - first
+    if n_valid < n_ranks:
+        raise ValueError("Cannot split {} time steps over {} ranks".format(n_valid, n_ranks))
+
+    bounds = first + (np.arange(n_ranks+1) * n_valid) // n_ranks
+    return [TimeSlab(int(a), int(b), int(a) - past_depth, int(b) + future_depth)
+                for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+# spatial tile of one rank: the rank produces states for lattice rows
+# [y_start, y_stop) and columns [x_start, x_stop) of its time slab
+Tile = namedtuple('Tile', ['y_start', 'y_stop', 'x_start', 'x_stop'])
+
+
+def partition_lattice(lattice_shape, tiles, halo=0, periodic=(False, False)):
+    '''
+    Splits a Y by X spatial lattice into tiles[0] by tiles[1] tiles. Along open
+    axes the sites within halo of the lattice edges have no full lightcones,
+    so the remaining sites are split evenly and the margins added to the edge
+    tiles; every tile then has the same number of lightcones to within one
+    row or column.
+
+    Returns
+    -------
+    tiles: list
+        Tile per tile index, in row-major (y, then x) order.
+    '''
+    bounds = []
+    for n, k, wraps in zip(lattice_shape, tiles, periodic):
+        margin = 0 if wraps else halo
+        n_valid = n - 2*margin
+        if k > n_valid:
+            raise ValueError("Cannot split {} sites with full lightcones into {} tiles".format(n_valid, k))
+        axis_bounds = margin + (np.arange(k+1) * n_valid) // k
+        axis_bounds[0], axis_bounds[-1] = 0, n
+        bounds.append(axis_bounds)
+    y_bounds, x_bounds = bounds
+    return [Tile(int(y_bounds[i]), int(y_bounds[i+1]), int(x_bounds[j]), int(x_bounds[j+1]))
+                for i in range(tiles[0]) for j in range(tiles[1])]
+
+
+class TimeAxis(object):
+    '''
+    Describes the time axis of a dataset stored as a sequence of files, each
+    holding a run of consecutive time steps (e.g. one netCDF file per day of
+    3-hourly climate data, or one .npy image per time step). Maps global time
+    step ranges to the files, and steps within those files, that hold them.
+    '''
+
+    def __init__(self, files, steps_per_file):
+        '''
+        Parameters
+        ----------
+        files: list
+            Files (or any identifiers passed through to the reader) in time order.
+
+        steps_per_file: int or array-like
+            Number of time steps in each file, either one value for all files or
+            one value per file.
+        '''
+        self.files = list(files)
+        steps = np.broadcast_to(np.asarray(steps_per_file, dtype=np.int64), (len(self.files),))
+        self.offsets = np.concatenate(([0], np.cumsum(steps)))
+        self.n_steps = int(self.offsets[-1])
+
+    def locate(self, step):
+        '''
+        Returns the index of the file holding global time step step, and the
+        index of that step within the file.
+        '''
+        if not 0 <= step < self.n_steps:
+            raise IndexError("Time step {} out of range for {} steps".format(step, self.n_steps))
+        f = int(np.searchsorted(self.offsets, step, side='right')) - 1
+        return f, int(step - self.offsets[f])
+
+    def segments(self, start, stop):
+        '''
+        Returns the (file, local_start, local_stop) triples, in time order, that
+        together hold the global time steps [start, stop).
+        '''
+        segments = []
+        step = start
+        while step < stop:
+            f, local = self.locate(step)
+            local_stop = min(int(self.offsets[f+1]), stop) - self.offsets[f]
+            segments.append((self.files[f], local, int(local_stop)))
+            step += int(local_stop) - local
+        return segments
+
+
+def _contiguous_runs(index):
+    # splits an index array into runs of consecutive indices, as
+    # (start, stop) of each run in the indexed axis and then in the index array
+    breaks = np.flatnonzero(np.diff(index) != 1) + 1
+    bounds = np.concatenate(([0], breaks, [len(index)]))
+    return [(int(index[a]), int(index[b-1]) + 1, int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def _read_ahead(read, segments, prefetch=True):
+    # yields (segment, read(*segment)) in order; with prefetch the next segment
+    # is read in a background thread while the caller handles the current one
+    if not prefetch:
+        for segment in segments:
+            yield segment, read(*segment)
+        return
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = None
+        for segment in segments:
+            future = pool.submit(read, *segment)
+            if pending is not None:
+                yield pending[0], pending[1].result()
+            pending = (segment, future)
+        if pending is not None:
+            yield pending[0], pending[1].result()
+
+
+class DiscoDriver(object):
+    '''
+    Domain decomposition for distributed DisCo runs. Given the time axis of the
+    data and the lightcone depths, works out which time steps each rank owns
+    and which halo steps it must read to extract full lightcones for them, so
+    run scripts do not have to. A typical distributed run is:
+
+    driver = DiscoDriver(TimeAxis(files, steps_per_file), past_depth, future_depth, comm)
+    field = driver.load(read)
+    model = DiscoReconstructor(past_depth, future_depth, c)
+    model.extract(field)
+    ...
+
+    and model.state_field then holds the states of driver.slab.start up to
+    driver.slab.stop.
+
+    With tiles=(n_y, n_x) each time step is also split into spatial tiles, and
+    ranks are laid out as time slab by tile (rank = slab_index*n_y*n_x + tile_index).
+    Each rank then loads its tile plus spatial halos of max(past_depth, future_depth)
+    *propagation_speed sites, wrapped around the axes given as periodic (none
+    by default), and must extract it with boundary_condition='open'. driver.owned_states() cuts the rank's own
+    tile out of the resulting state field, and driver.gather_states() stitches
+    all of them into the global state field.
+
+    Given lattice_shape, untiled runs (tiles=(1, 1)) load the same windows, the
+    whole lattice plus halos wrapped around periodic axes, so that their states
+    match those of tiled runs site for site.
+    '''
+
+    def __init__(self, time_axis, past_depth, future_depth, comm=None, start=None, stop=None,
+                 tiles=(1, 1), lattice_shape=None, propagation_speed=1, periodic=(False, False)):
+        '''
+        Parameters
+        ----------
+        time_axis: TimeAxis
+            Files and time steps of the data.
+
+        past_depth, future_depth: int
+            Lightcone depths of the reconstruction.
+
+        comm: mpi4py communicator, optional (default=None)
+            Communicator to decompose over. If None, runs as a single rank.
+
+        start, stop: int, optional (default=None)
+            Global time steps to produce states for, see partition_time().
+
+        tiles: tuple, optional (default=(1, 1))
+            Number of spatial tiles along (y, x) per time step. The number of
+            ranks must be a multiple of n_y*n_x.
+
+        lattice_shape: tuple, optional (default=None)
+            (Y, X) shape of the spatial lattice; required for spatial tiling.
+            If given, ranks load windows with halos even without tiling.
+
+        propagation_speed: int, optional (default=1)
+            Propagation speed of the reconstruction, which together with the
+            lightcone depths sets the width of the spatial halos.
+
+        periodic: tuple, optional (default=(False, False))
+            Whether the halos of the (y, x) axes wrap around the lattice, e.g.
+            (False, True) for open latitude and periodic longitude. Along open
+            axes the sites within a halo width of the lattice edge are margin,
+            as for boundary_condition='open', and are assigned the NAN state 0;
+            with the default, untiled runs give the same states as extracting
+            the bare lattice with open boundaries.
+        '''
+        self.time_axis = time_axis
+        self.past_depth = past_depth
+        self.future_depth = future_depth
+        self.comm = comm
+        if comm is None:
+            self.rank, self.size = 0, 1
+        else:
+            self.rank, self.size = comm.Get_rank(), comm.Get_size()
+
+        self.tiles = tuple(tiles)
+        self.n_tiles = self.tiles[0]*self.tiles[1]
+        if self.size % self.n_tiles != 0:
+            raise ValueError("Number of ranks {} is not a multiple of the {} spatial tiles".format(
+                                self.size, self.n_tiles))
+        self.slab_index, self.tile_index = divmod(self.rank, self.n_tiles)
+        time_slabs = partition_time(time_axis.n_steps, past_depth, future_depth,
+                                    self.size // self.n_tiles, start, stop)
+        self.slabs = [slab for slab in time_slabs for _ in range(self.n_tiles)]
+        self.slab = self.slabs[self.rank]
+
+        self.lattice_shape = lattice_shape
+        self.periodic = tuple(periodic)
+        self._halo = max(past_depth, future_depth)*propagation_speed
+        if lattice_shape is not None:
+            self.tile_list = partition_lattice(lattice_shape, self.tiles, self._halo, self.periodic)
+            self.tile = self.tile_list[self.tile_index]
+        elif self.tiled:
+            raise ValueError("lattice_shape is required for spatial tiling")
+        else:
+            self.tile_list = None
+            self.tile = None
+        self.node_comms = None
+        self.n_threads = None
+
+    @property
+    def tiled(self):
+        '''
+        True if time steps are split into spatial tiles.
+        '''
+        return self.n_tiles > 1
+
+    @property
+    def windowed(self):
+        '''
+        True if ranks load lattice windows, their tile plus halos, which is the
+        case whenever lattice_shape is given, tiled or not. Windowed fields are
+        extracted with boundary_condition='open'.
+        '''
+        return self.tile is not None
+
+    def setup_hybrid(self, n_threads=None, ranks_per_node=None):
+        '''
+        Configures a hybrid MPI + threads run, with one rank per node or socket
+        and threads inside it. Splits the communicator into DiscoDriver.node_comms
+        for node-local reductions (pass them to DiscoReconstructor.reduce_morphs())
+        and sets the number of numba threads of this rank.
+
+        Parameters
+        ----------
+        n_threads: int, optional (default=None)
+            Threads per rank. If None, the cores this rank is bound to, or, if
+            it is not bound, its share of the node's cores.
+
+        ranks_per_node: int, optional (default=None)
+            Emulated ranks per node, see split_node_comms().
+
+        Returns
+        -------
+        n_threads: int
+            Threads per rank, to pass on to d4p.daalinit() and
+            DiscoReconstructor(n_workers=...).
+        '''
+        import numba
+        if self.comm is None:
+            raise ValueError("A hybrid run needs a communicator")
+        self.node_comms = split_node_comms(self.comm, ranks_per_node)
+        if n_threads is None:
+            cores = len(os.sched_getaffinity(0))
+            if cores == os.cpu_count():
+                cores //= self.node_comms.node.Get_size()
+            n_threads = max(cores, 1)
+        self.n_threads = min(n_threads, numba.config.NUMBA_NUM_THREADS)
+        numba.set_num_threads(self.n_threads)
+        return self.n_threads
+
+    def window(self, tile=None):
+        '''
+        Lattice rows and columns, as index arrays, that a rank with the given
+        tile (default: this rank's) loads: the tile plus halos, wrapped around
+        periodic axes and clipped at open ones.
+        '''
+        tile = self.tile if tile is None else tile
+        axes = []
+        for lo, hi, n, wraps in ((tile.y_start, tile.y_stop, self.lattice_shape[0], self.periodic[0]),
+                                 (tile.x_start, tile.x_stop, self.lattice_shape[1], self.periodic[1])):
+            if wraps:
+                axes.append(np.arange(lo - self._halo, hi + self._halo) % n)
+            else:
+                axes.append(np.arange(max(lo - self._halo, 0), min(hi + self._halo, n)))
+        return tuple(axes)
+
+    def _window_shape(self, frame_shape):
+        # shape of the tile window of full lattice frames of the given shape
+        if not self.windowed:
+            return tuple(frame_shape)
+        return tuple(frame_shape[:-2]) + tuple(len(index) for index in self.window())
+
+    def _cut_window(self, frames, tile=None):
+        # tile window of full lattice frames, as a contiguous array
+        if not self.windowed:
+            return np.asarray(frames)
+        rows, cols = self.window(tile)
+        return np.ascontiguousarray(np.asarray(frames)[:, rows][:, :, cols])
+
+    def input_segments(self):
+        '''
+        (file, local_start, local_stop) triples this rank reads, halos included.
+        '''
+        return self.time_axis.segments(self.slab.input_start, self.slab.input_stop)
+
+    def owned_segments(self):
+        '''
+        (file, local_start, local_stop) triples of the time steps this rank
+        produces states for, e.g. to name output files.
+        '''
+        return self.time_axis.segments(self.slab.start, self.slab.stop)
+
+    def read_plan(self):
+        '''
+        Assigns every file holding time steps some rank needs to exactly one
+        reading rank: a rank of the time slab owning the first needed step of the
+        file, or of the first or last slab for files that only hold halo steps.
+        With spatial tiling the files of a slab are spread over its tiles' ranks.
+
+        Returns
+        -------
+        plan: list
+            (file_index, start, stop, reader) tuples in time order, where
+            [start, stop) are the global time steps needed from the file.
+        '''
+        axis = self.time_axis
+        time_slabs = self.slabs[::self.n_tiles]
+        first, last = time_slabs[0].input_start, time_slabs[-1].input_stop
+        owned_starts = np.array([slab.start for slab in time_slabs])
+        plan = []
+        step = first
+        while step < last:
+            f, _ = axis.locate(step)
+            stop = min(int(axis.offsets[f+1]), last)
+            owned = min(max(step, time_slabs[0].start), time_slabs[-1].stop - 1)
+            slab_index = int(np.searchsorted(owned_starts, owned, side='right')) - 1
+            plan.append((f, step, stop, slab_index*self.n_tiles + f % self.n_tiles))
+            step = stop
+        return plan
+
+    def load(self, read, exchange=True, dtype=None, prefetch=False):
+        '''
+        Reads this rank's slab of the field, halos included, ready to pass to
+        DiscoReconstructor.extract(). With spatial tiling only the rank's tile
+        window (see .window()) is returned, and it must be extracted with
+        boundary_condition='open'.
+
+        With exchange=True (the default), each file is read once, by the rank
+        read_plan() assigns it to, which then sends the steps (and tile windows)
+        other ranks need from it with point-to-point messages. Neighbouring ranks
+        therefore do not re-read the files holding their shared halo steps.
+
+        Parameters
+        ----------
+        read: callable
+            read(file, local_start, local_stop) returns the time steps
+            [local_start, local_stop) of file as an array with time first. All
+            files must give the same shape and dtype per time step.
+
+        exchange: bool, optional (default=True)
+            Read files once and exchange halos over comm. With exchange=False
+            every rank reads all of its own steps, which is better when the
+            data is a single large file that can be sliced directly.
+
+        dtype: numpy dtype, optional (default=None)
+            dtype of the returned field; if None, that of the files.
+
+        prefetch: bool, optional (default=False)
+            Read the next file in a background thread while the current one is
+            copied and sent on.
+        '''
+        return self._load(lambda f, start, stop: [read(f, start, stop)], exchange, dtype, prefetch)[0]
+
+    def load_netcdf(self, directory, variables, exchange=True, dtype=np.float32, prefetch=True):
+        '''
+        Reads this rank's slab of several variables of the netCDF files of the
+        time axis, as .load() does for one. Each file is opened once, all
+        variables are read into preallocated contiguous arrays of the given
+        dtype (without masking fill values), and the next file is read in a
+        background thread while the current one is copied and sent on.
+
+        Parameters
+        ----------
+        directory: str
+            Directory of the files of the time axis.
+
+        variables: list of str
+            Names of the variables to read.
+
+        exchange, dtype, prefetch: optional
+            As for .load(), but by default float32 fields are read with prefetch.
+
+        Returns
+        -------
+        fields: dict
+            The field of each variable, by name.
+        '''
+        from netCDF4 import Dataset
+        def read(f, start, stop):
+            with Dataset(os.path.join(directory, f), 'r') as data:
+                data.set_auto_mask(False)
+                return [data[variable][start:stop] for variable in variables]
+        return dict(zip(variables, self._load(read, exchange, dtype, prefetch)))
+
+    def load_array(self, source, offset=0, dtype=None):
+        '''
+        Reads this rank's slab, halos included, from a single lazily sliced
+        source holding the whole time axis -- a memory-mapped .npy file
+        (np.load(path, mmap_mode='r')), an HDF5 dataset or a netCDF variable --
+        as .load() does from files. Only the rank's time steps, and with a
+        lattice_shape only its tile window, are read from the source.
+
+        Parameters
+        ----------
+        source: array-like
+            Field with time first, sliceable like an ndarray.
+
+        offset: int, optional (default=0)
+            Index in source of step 0 of the time axis, e.g. to skip transients.
+
+        dtype: numpy dtype, optional (default=None)
+            dtype of the returned field; if None, that of the source.
+        '''
+        steps = slice(offset + self.slab.input_start, offset + self.slab.input_stop)
+        if not self.windowed:
+            return np.asarray(source[steps], dtype=dtype)
+
+        # lazy sources slice efficiently (h5py only at all) with basic slices, so
+        # the window is read as its blocks of consecutive, possibly wrapped, sites
+        rows, cols = self.window()
+        field = np.empty((steps.stop - steps.start,) + self._window_shape(source.shape[1:]),
+                         dtype=dtype or source.dtype)
+        for y_start, y_stop, i, j in _contiguous_runs(rows):
+            for x_start, x_stop, k, l in _contiguous_runs(cols):
+                field[..., i:j, k:l] = source[steps, ..., y_start:y_stop, x_start:x_stop]
+        return field
+
+    def _load(self, read, exchange, dtype, prefetch):
+        # .load() for read() returning a list of arrays, one per variable;
+        # returns the list of this rank's fields
+        slab = self.slab
+        n_input = slab.input_stop - slab.input_start
+        if self.comm is None or self.size == 1 or not exchange:
+            fields = None
+            position = 0
+            for (f, start, stop), arrays in _read_ahead(read, self.input_segments(), prefetch):
+                if fields is None:
+                    fields = [np.empty((n_input,) + self._window_shape(array.shape[1:]), dtype=dtype or array.dtype)
+                                  for array in arrays]
+                for field, array in zip(fields, arrays):
+                    field[position : position + stop - start] = self._cut_window(array)
+                position += stop - start
+            if fields is None:
+                raise ValueError("No input files hold time steps [{}, {})".format(slab.input_start, slab.input_stop))
+            return fields
+
+        from mpi4py import MPI
+        axis = self.time_axis
+        plan = self.read_plan()
+        input_starts = np.array([other.input_start for other in self.slabs])
+        input_stops = np.array([other.input_stop for other in self.slabs])
+
+        def read_global(f, start, stop):
+            offset = int(axis.offsets[f])
+            return read(axis.files[f], start - offset, stop - offset)
+        my_reads = [(f, start, stop) for f, start, stop, reader in plan if reader == self.rank]
+        chunks = _read_ahead(read_global, my_reads, prefetch)
+        first = next(chunks, None)
+
+        # shape and dtype of one time step of each variable, from any rank that read a file;
+        # ranks the plan gives no files still need it to receive their steps
+        meta = [] if first is None else [[(array.shape[1:], array.dtype) for array in first[1]]]
+        metas = next((m for metas in self.comm.allgather(meta) for m in metas), None)
+        if metas is None:
+            # the same on every rank, so they all raise
+            raise ValueError("No rank read an input file; the read plan is empty")
+        fields = [np.empty((n_input,) + self._window_shape(shape), dtype=dtype or file_dtype)
+                      for shape, file_dtype in metas]
+
+        # tags only need to tell apart the files exchanged between one pair of
+        # ranks, and messages between a pair arrive in the order they are posted
+        requests = []
+        for f, start, stop, reader in plan:
+            a, b = max(start, slab.input_start), min(stop, slab.input_stop)
+            if reader != self.rank and a < b:
+                for field in fields:
+                    requests.append(self.comm.Irecv(field[a-slab.input_start : b-slab.input_start],
+                                                    source=reader, tag=f % 32768))
+        for (f, start, stop), arrays in chain([first] if first is not None else [], chunks):
+            # ranks whose input steps overlap [start, stop)
+            lo = int(np.searchsorted(input_stops, start, side='right'))
+            hi = int(np.searchsorted(input_starts, stop, side='left'))
+            for r in range(lo, hi):
+                a, b = max(start, input_starts[r]), min(stop, input_stops[r])
+                tile = self.tile_list[r % self.n_tiles] if self.windowed else None
+                for field, array in zip(fields, arrays):
+                    piece = self._cut_window(array[a-start : b-start], tile)
+                    if r == self.rank:
+                        field[a-slab.input_start : b-slab.input_start] = piece
+                    else:
+                        requests.append(self.comm.Isend(np.ascontiguousarray(piece, dtype=field.dtype),
+                                                        dest=r, tag=f % 32768))
+        MPI.Request.Waitall(requests)
+        return fields
+
+    def owned_states(self, state_field):
+        '''
+        Part of this rank's state field (from .causal_filter() on the loaded
+        field) covering its own tile, cutting away the halo sites. Without a
+        lattice_shape this is the whole state field.
+        '''
+        if not self.windowed:
+            return state_field
+        rows, cols = self.window()
+        y0 = self.tile.y_start - rows[0] if not self.periodic[0] else self._halo
+        x0 = self.tile.x_start - cols[0] if not self.periodic[1] else self._halo
+        return state_field[:, y0 : y0 + self.tile.y_stop - self.tile.y_start,
+                              x0 : x0 + self.tile.x_stop - self.tile.x_start]
+
+    def gather_states(self, state_field, root=0):
+        '''
+        Stitches the owned states of all ranks into the global state field, of
+        shape (n_steps, Y, X) for the n_steps time steps produced, on rank root.
+        Returns None on the other ranks. Meant for runs whose state field fits
+        on one rank.
+        '''
+        owned = self.owned_states(state_field)
+        if self.comm is None:
+            return owned
+        pieces = self.comm.gather((self.slab, self.tile, owned), root=root)
+        if self.rank != root:
+            return None
+
+        first = self.slabs[0].start
+        shape = self.lattice_shape if self.windowed else owned.shape[1:]
+        states = np.zeros((self.slabs[-1].stop - first,) + tuple(shape), dtype=owned.dtype)
+        for slab, tile, piece in pieces:
+            if tile is None:
+                states[slab.start-first : slab.stop-first] = piece
+            else:
+                states[slab.start-first : slab.stop-first,
+                       tile.y_start : tile.y_stop,
+                       tile.x_start : tile.x_stop] = piece
+        return states
+
+    def load_imbalance(self, n_points):
+        '''
+        Gathers the number of spacetime points each rank works on, e.g. the
+        number of lightcones len(model.plcs) after .extract(), on every rank.
+
+        Returns
+        -------
+        counts: ndarray
+            Number of points of each rank.
+
+        imbalance: float
+            max(counts)/mean(counts) - 1, the fraction of time the average rank
+            idles waiting on the busiest one; 0 for a perfectly balanced run.
+        '''
+        if self.comm is None:
+            counts = np.array([n_points])
+        else:
+            counts = np.array(self.comm.allgather(int(n_points)))
+        return counts, counts.max()/counts.mean() - 1
+
+    def write_states(self, path, state_field, dims=('time', 'lat', 'lon'), coords=None, coord_attrs=None,
+                     variable='states', complevel=4, parallel=None):
+        '''
+        Writes the owned states of every rank into its hyperslab of a single
+        chunked, compressed netCDF4 dataset, with coordinate variables along all
+        three dimensions. Call on all ranks. The global attribute first_step
+        records the global time step (see TimeAxis) of the first stored step.
+
+        If netCDF4 was built with parallel HDF5 the ranks write collectively to
+        one shared file; otherwise they take turns writing their hyperslabs.
+
+        Parameters
+        ----------
+        path: str
+            Path of the netCDF4 file to create.
+
+        state_field: ndarray
+            This rank's state field from .causal_filter() on the loaded field.
+
+        dims: tuple, optional (default=('time', 'lat', 'lon'))
+            Names of the time and two spatial dimensions.
+
+        coords: dict, optional (default=None)
+            Coordinate values keyed by dimension name. Time coordinates cover
+            this rank's owned time steps only, spatial ones the whole lattice.
+            Missing coordinates default to global time step and lattice indices.
+
+        coord_attrs: dict, optional (default=None)
+            netCDF attributes (e.g. units, calendar) of the coordinate variables,
+            keyed by dimension name.
+
+        variable: str, optional (default='states')
+            Name of the state field variable.
+
+        complevel: int, optional (default=4)
+            zlib compression level.
+
+        parallel: bool, optional (default=None)
+            Force collective (True) or turn-taking (False) writes; by default
+            collective writes are used when netCDF4 supports them.
+        '''
+        import netCDF4
+
+        owned = np.ascontiguousarray(self.owned_states(state_field))
+        first = self.slabs[0].start
+        n_steps = self.slabs[-1].stop - first
+        lattice = tuple(self.lattice_shape) if self.windowed else owned.shape[1:]
+        time_dim, y_dim, x_dim = dims
+        coords = {} if coords is None else dict(coords)
+        coord_attrs = {} if coord_attrs is None else coord_attrs
+        coords.setdefault(time_dim, np.arange(self.slab.start, self.slab.stop))
+        coords.setdefault(y_dim, np.arange(lattice[0]))
+        coords.setdefault(x_dim, np.arange(lattice[1]))
+
+        times = slice(self.slab.start - first, self.slab.stop - first)
+        if self.windowed:
+            rows = slice(self.tile.y_start, self.tile.y_stop)
+            cols = slice(self.tile.x_start, self.tile.x_stop)
+        else:
+            rows, cols = slice(None), slice(None)
+
+        def create(dataset):
+            dataset.first_step = first
+            dataset.past_depth = self.past_depth
+            dataset.future_depth = self.future_depth
+            for dim, n in zip(dims, (n_steps,) + lattice):
+                dataset.createDimension(dim, n)
+                var = dataset.createVariable(dim, np.asarray(coords[dim]).dtype, (dim,))
+                var.setncatts(coord_attrs.get(dim, {}))
+            states = dataset.createVariable(variable, owned.dtype, dims, zlib=True, complevel=complevel,
+                                            chunksizes=(1,) + lattice)
+            states.long_name = 'local causal state'
+            return states
+
+        def write(dataset, states):
+            # spatial coordinates are the same on every rank
+            if self.rank == 0:
+                dataset[y_dim][:] = coords[y_dim]
+                dataset[x_dim][:] = coords[x_dim]
+            dataset[time_dim][times] = coords[time_dim]
+            states[times, rows, cols] = owned
+
+        if parallel is None:
+            parallel = self.comm is not None and self.size > 1 and bool(netCDF4.__has_parallel4_support__)
+
+        if parallel:
+            from mpi4py import MPI
+            with netCDF4.Dataset(path, 'w', parallel=True, comm=self.comm, info=MPI.Info()) as dataset:
+                states = create(dataset)
+                # compressed variables can only be written collectively
+                states.set_collective(True)
+                write(dataset, states)
+            return
+
+        # ranks write their hyperslabs in turn, passing a token along
+        if self.rank > 0:
+            self.comm.recv(source=self.rank - 1, tag=0)
+        with netCDF4.Dataset(path, 'w' if self.rank == 0 else 'a') as dataset:
+            states = create(dataset) if self.rank == 0 else dataset[variable]
+            write(dataset, states)
+        if self.comm is not None:
+            if self.rank < self.size - 1:
+                self.comm.send(None, dest=self.rank + 1, tag=0)
+            self.comm.Barrier()
@@ -0,0 +1,95 @@
+'''
+brief: Benchmark of hybrid MPI + threads against flat MPI on one machine
+usage: mpirun -n <ranks> python bench-hybrid.py [threads_per_rank] [ranks_per_node]
+dependencies: python3, numpy, numba, mpi4py, daal4py
+
+Runs the distributed pipeline on a synthetic field with the given number of
+threads per rank (default 1) and prints its per-stage telemetry, then times the
+joint distribution reduction as a flat Allreduce over all ranks and as a
+node-local reduction followed by an Allreduce over node leaders. Nodes are
+emulated by groups of ranks_per_node consecutive ranks (default: the ranks
+sharing this machine's memory).
+
+Compare flat MPI against hybrid runs on the same cores, e.g.
+
+mpirun -n 8 python bench-hybrid.py 1 4
+mpirun -n 2 python bench-hybrid.py 4 1
+'''
+
+import time
+import numpy as np
+
+import os, sys
+module_path = os.path.abspath(os.path.join('../src/'))
+sys.path.append(module_path)
+from pdisco import *
+
+from mpi4py import MPI
+comm = MPI.COMM_WORLD
+size = comm.Get_size()
+rank = comm.Get_rank()
+
+n_threads = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+ranks_per_node = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+p_depth = 3
+f_depth = 2
+c = 1
+K_past = 8
+K_future = 8
+T, Y, X = 48, 64, 64
+
+
+def best_of(func, repeats=20):
+    times = []
+    for _ in range(repeats):
+        comm.Barrier()
+        start = time.perf_counter()
+        func()
+        times.append(comm.allreduce(time.perf_counter() - start, op=MPI.MAX))
+    return min(times)
+
+
+# synthetic field: noisy travelling waves, "read" from memory in steps of one file each
+t, y, x = np.meshgrid(np.arange(T), np.arange(Y), np.arange(X), indexing='ij')
+rng = np.random.default_rng(0)
+field = (np.sin(2*np.pi*(x - t)/16) + np.cos(2*np.pi*(y + t)/24)
+            + 0.1*rng.standard_normal((T, Y, X))).astype(np.float32)
+
+driver = DiscoDriver(TimeAxis(list(range(T)), 1), p_depth, f_depth, comm)
+n_threads = driver.setup_hybrid(n_threads, ranks_per_node)
+myfield = driver.load(lambda f, start, stop: field[f:f+1][start:stop])
+
+comm.Barrier()
+start = time.perf_counter()
+d4p.daalinit(n_threads)
+recon = DiscoReconstructor(p_depth, f_depth, c, n_workers=n_threads, telemetry=True)
+recon.extract(myfield, boundary_condition='periodic')
+recon.kmeans_lightcones({'nClusters':K_past, 'maxIterations':50},
+                        {'nClusters':K_future, 'maxIterations':50},
+                        past_init_params={'nClusters':K_past, 'method':'randomDense', 'distributed':True},
+                        future_init_params={'nClusters':K_future, 'method':'randomDense', 'distributed':True})
+recon.reconstruct_morphs()
+recon.reduce_morphs(comm, node_comms=driver.node_comms)
+recon.reconstruct_states(chi_squared)
+recon.causal_filter()
+pipeline_time = comm.allreduce(time.perf_counter() - start, op=MPI.MAX)
+assert np.array_equal(recon.global_joint_dist, recon.joint_counts.allreduce(comm).counts)
+
+summary = recon.telemetry_report(comm)
+if rank == 0:
+    print('{} ranks x {} threads, {} ranks per node'.format(size, n_threads, driver.node_comms.node.Get_size()))
+    print('Pipeline: {:.3f} s'.format(pipeline_time))
+    print(summary)
+
+# the reduction alone, for joint distributions of increasing size
+for K in (64, 512, 2048):
+    counts = JointCounts(K, K, rng.integers(0, 100, (K, K)).astype(np.uint64))
+    flat = best_of(lambda: counts.allreduce(comm))
+    hierarchical = best_of(lambda: counts.node_allreduce(driver.node_comms))
+    assert np.array_equal(counts.allreduce(comm).counts, counts.node_allreduce(driver.node_comms).counts)
+    if rank == 0:
+        print('{0}x{0} joint distribution: flat Allreduce {1:.5f} s, node-local then leaders {2:.5f} s'.format(
+                K, flat, hierarchical))
+
+d4p.daalfini()
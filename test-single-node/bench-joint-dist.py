@@ -0,0 +1,77 @@
+'''
+brief: Benchmark of the joint distribution builder on the single-node turbulence data
+usage: python bench-joint-dist.py
+dependencies: python3, numpy, numba, daal4py
+
+Compares the vectorized dist_from_data against the original Counter(zip(...))
+implementation on the past and future labels of the test-single-node pipeline.
+'''
+
+import time
+from collections import Counter
+
+import numpy as np
+
+import os, sys
+module_path = os.path.abspath(os.path.join('../src/'))
+sys.path.append(module_path)
+from pdisco import *
+
+
+def counter_dist_from_data(X, Y, Nx, Ny):
+    # original pure-Python implementation, kept here as the reference
+    dist = np.zeros((Nx, Ny), dtype=np.uint64)
+    counts = Counter(zip(X,Y))
+    for pair, count in counts.items():
+        dist[pair] = count
+    return dist
+
+
+def best_of(func, *args, repeats=5):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+turb_field = np.load("./turb_small.npy")
+
+# Same parameters as single-node-turb.py
+p_depth = 3
+f_depth = 1
+c = 1
+K_past = 3
+K_future = 10
+decay_type='spacetime'
+p_decay = 0.05
+f_decay = 0.0
+
+past_params = {'nClusters':K_past, 'maxIterations':200}
+future_params = {'nClusters':K_future, 'maxIterations':200}
+p_i_params = {'nClusters':K_past, 'method':'randomDense', 'distributed': False}
+f_i_params = {'nClusters':K_future, 'method':'randomDense', 'distributed': False}
+
+model = DiscoReconstructor(p_depth, f_depth, c, distributed=False)
+model.extract(turb_field, boundary_condition='periodic')
+model.kmeans_lightcones(past_params,
+                        future_params,
+                        decay_type=decay_type,
+                        past_decay=p_decay,
+                        future_decay=f_decay,
+                        past_init_params=p_i_params,
+                        future_init_params=f_i_params,)
+
+pasts, futures = model.pasts, model.futures
+print('Number of spacetime points: {}'.format(len(pasts)))
+
+old_time, old_dist = best_of(counter_dist_from_data, pasts, futures, K_past, K_future, repeats=1)
+new_time, new_dist = best_of(dist_from_data, pasts, futures, K_past, K_future)
+
+assert np.array_equal(old_dist, new_dist), 'joint distributions do not match'
+assert new_dist.dtype == old_dist.dtype
+
+print('Counter(zip(...)):  {:.4f} s'.format(old_time))
+print('dist_from_data:     {:.4f} s'.format(new_time))
+print('Speedup:            {:.1f}x'.format(old_time/new_time))
@@ -0,0 +1,76 @@
+'''
+brief: Serial checks of the local causal state updates on synthetic joint distributions
+usage: python check-states.py
+dependencies: python3, numpy, scipy, numba, daal4py
+
+Builds joint distributions whose pasts fall into a few groups with distinct
+morphs, reconstructs the states, and checks the online state update when all
+pasts of a state move to another: the emptied state must be dropped, with the
+state table, label map and a saved model agreeing on the remaining states.
+Multinomial bootstrap resamples of the joint distribution, including an
+all-zero one, must keep its total count.
+'''
+
+import os, sys, tempfile
+import numpy as np
+from scipy.sparse import csr_matrix
+
+module_path = os.path.abspath(os.path.join('../src/'))
+sys.path.append(module_path)
+from pdisco import *
+
+N_futures = 12
+n_groups = 3
+pasts_per_group = 4
+
+# well separated morphs, the same for all pasts of a group, so that every group is one state
+protos = np.full((n_groups, N_futures), 0.01)
+for g in range(n_groups):
+    protos[g, 4*g:4*g+4] = 1
+protos /= protos.sum(axis=1, keepdims=True)
+groups = np.repeat(np.arange(n_groups), pasts_per_group)
+joint = np.round(5000*protos[groups]).astype(np.uint64)
+
+for sparse in (False, True):
+    model = DiscoReconstructor(1, 1, 1, distributed=False)
+    model._N_pasts, model._N_futures = joint.shape
+    model.local_joint_dist = csr_matrix(joint) if sparse else joint.copy()
+    model.reconstruct_states(chi_squared)
+    assert len(model.states) == n_groups, 'expected {} states, got {}'.format(n_groups, len(model.states))
+
+    # move every past of the first group to the morph of the second
+    moved = np.flatnonzero(groups == 0)
+    emptied = model.label_map[moved[0]]
+    target = model.label_map[np.flatnonzero(groups == 1)[0]]
+    deltas = joint[np.flatnonzero(groups == 1)[:len(moved)]].astype(np.int64) - joint[moved].astype(np.int64)
+    relabeled, removed = model.update_states(moved, deltas, chi_squared)
+
+    assert removed == [emptied], 'removed {}, expected [{}]'.format(removed, emptied)
+    assert relabeled == {past: (emptied, target) for past in moved}
+    assert emptied not in model.label_map
+    table = model.state_table
+    assert len(model.states) == table.n_states == n_groups - 1
+    assert (table.n_pasts[:table.n_states] > 0).all()
+    dist = model._morph_dist()
+    dist = dist.toarray() if sparse else dist
+    for row, state in enumerate(model.states):
+        members = np.flatnonzero(table.past_states == row)
+        assert state.index == table.indices[row] and (model.label_map[members] == state.index).all()
+        assert np.array_equal(table.counts[row], dist[members].sum(axis=0))
+        assert all(model.epsilon_map[past].index == state.index for past in members)
+
+    # a saved model holds only the remaining states
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'model.npz')
+        model.save(path)
+        loaded = DiscoReconstructor.load(path)
+    assert np.array_equal(loaded.label_map, model.label_map)
+    assert sorted(state.index for state in loaded.states) == sorted(state.index for state in model.states)
+    print('{}: emptied state {} dropped, {} states left'.format('sparse' if sparse else 'dense', emptied, len(model.states)))
+
+# bootstrap resamples keep the total count, and an all-zero distribution resamples to zeros
+for dist in (joint, csr_matrix(joint), np.zeros_like(joint), csr_matrix(joint.shape, dtype=np.uint64)):
+    resample = resample_joint_counts(dist, np.random.default_rng(0))
+    assert resample is not dist and resample.shape == joint.shape and resample.dtype == np.uint64
+    assert resample.sum() == dist.sum()
+print('multinomial resamples keep their totals, including all-zero ones')
@@ -0,0 +1,224 @@
+'''
+brief: Check of the DiscoDriver domain decomposition on synthetic data
+usage: mpirun -n 4 python mpi-driver.py [n_tiles_y n_tiles_x]
+dependencies: python3, numpy, numba, mpi4py, daal4py, netCDF4
+
+Writes a small synthetic field to one .npy file per few time steps, has every
+rank load its slab (owned steps plus halos) through DiscoDriver, and checks the
+slabs against the full field and that every file was read by exactly one rank.
+The slabs read lazily from one memory-mapped file, and two variables loaded
+together from netCDF files, are checked the same way, before the distributed
+pipeline runs and the state field is gathered on rank 0.
+Any number of ranks up to the number of time steps with full lightcones works.
+
+Given n_tiles_y and n_tiles_x, each time step is also split into spatial tiles
+(periodic in x, open in y); the number of ranks must then be a multiple of
+n_tiles_y*n_tiles_x. The lightcones of every tile (the whole lattice when
+untiled) are checked against those extracted from the whole field, so stitched
+state fields have no seams, and the trained model must filter the same states
+on the tiled decomposition as on an untiled one.
+
+Finally all ranks write their states into one netCDF4 file, which must read
+back as the gathered state field, and a run restored from the checkpoint
+written after the last stage must filter to the same states. States are the
+consensus of a permutation ensemble, which must agree over all ranks.
+'''
+
+import os, sys, shutil, tempfile
+import numpy as np
+from netCDF4 import Dataset
+
+module_path = os.path.abspath(os.path.join('../src/'))
+sys.path.append(module_path)
+from pdisco import *
+
+from mpi4py import MPI
+comm = MPI.COMM_WORLD
+size = comm.Get_size()
+rank = comm.Get_rank()
+
+p_depth = 3
+f_depth = 2
+c = 1
+K_past = 4
+K_future = 6
+steps_per_file = 5
+n_files = 8
+tiles = tuple(int(n) for n in sys.argv[1:3]) or (1, 1)
+
+# synthetic field: noisy travelling waves, the same on every rank
+T, Y, X = steps_per_file*n_files, 24, 32
+t, y, x = np.meshgrid(np.arange(T), np.arange(Y), np.arange(X), indexing='ij')
+rng = np.random.default_rng(0)
+field = (np.sin(2*np.pi*(x - t)/8) + np.cos(2*np.pi*(y + t)/12)
+            + 0.1*rng.standard_normal((T, Y, X))).astype(np.float32)
+
+data_dir = tempfile.mkdtemp() if rank == 0 else None
+data_dir = comm.bcast(data_dir, root=0)
+files = ['synthetic_{:03d}.npy'.format(i) for i in range(n_files)]
+if rank == 0:
+    for i, f in enumerate(files):
+        np.save(os.path.join(data_dir, f), field[i*steps_per_file : (i+1)*steps_per_file])
+comm.Barrier()
+
+driver = DiscoDriver(TimeAxis(files, steps_per_file), p_depth, f_depth, comm,
+                     tiles=tiles, lattice_shape=(Y, X), propagation_speed=c, periodic=(False, True))
+slab = driver.slab
+reads = []
+def read(f, start, stop):
+    reads.append(f)
+    return np.load(os.path.join(data_dir, f))[start:stop]
+myfield = driver.load(read)
+rows, cols = driver.window()
+expected = field[slab.input_start:slab.input_stop][:, rows][:, :, cols]
+assert np.array_equal(myfield, expected), 'rank {} loaded the wrong steps'.format(rank)
+
+# the same steps, read lazily from one memory-mapped .npy file of the whole run
+if rank == 0:
+    np.save(os.path.join(data_dir, 'synthetic.npy'), field)
+comm.Barrier()
+lazy = driver.load_array(np.load(os.path.join(data_dir, 'synthetic.npy'), mmap_mode='r'))
+assert np.array_equal(lazy, expected), 'rank {} read the wrong memory-mapped steps'.format(rank)
+
+# the same steps of two variables, from netCDF files each opened once
+nc_files = [f.replace('.npy', '.nc') for f in files]
+if rank == 0:
+    for i, f in enumerate(nc_files):
+        with Dataset(os.path.join(data_dir, f), 'w') as data:
+            data.createDimension('time', steps_per_file)
+            data.createDimension('y', Y)
+            data.createDimension('x', X)
+            for name, sign in (('u', 1), ('v', -1)):
+                data.createVariable(name, 'f8', ('time', 'y', 'x'))[:] = sign*field[i*steps_per_file : (i+1)*steps_per_file]
+comm.Barrier()
+nc_driver = DiscoDriver(TimeAxis(nc_files, steps_per_file), p_depth, f_depth, comm,
+                        tiles=tiles, lattice_shape=(Y, X), propagation_speed=c, periodic=(False, True))
+variables = nc_driver.load_netcdf(data_dir, ['u', 'v'])
+assert variables['u'].dtype == np.float32 and variables['u'].flags.c_contiguous
+assert np.array_equal(variables['u'], expected) and np.array_equal(variables['v'], -expected), \
+    'rank {} loaded the wrong netCDF steps'.format(rank)
+
+# owned slabs must tile the steps with full lightcones exactly once
+slabs = comm.gather(slab, root=0)
+if rank == 0:
+    slabs = slabs[::driver.n_tiles]
+    assert slabs[0].start == p_depth and slabs[-1].stop == T - f_depth
+    assert all(a.stop == b.start for a, b in zip(slabs[:-1], slabs[1:]))
+    sizes = [s.stop - s.start for s in slabs]
+    assert max(sizes) - min(sizes) <= 1
+    print('{} ranks, {} tiles, slab sizes {}'.format(size, tiles, sizes))
+
+all_reads = comm.gather(reads, root=0)
+if rank == 0:
+    all_reads = sorted(f for r in all_reads for f in r)
+    assert all_reads == files, 'files read {}'.format(all_reads)
+# without periodic axes, an untiled window is the bare lattice
+open_window = DiscoDriver(TimeAxis(files, steps_per_file), p_depth, f_depth, lattice_shape=(Y, X),
+                          propagation_speed=c).window()
+assert all(np.array_equal(index, np.arange(n)) for index, n in zip(open_window, (Y, X)))
+
+d4p.daalinit()
+recon = DiscoReconstructor(p_depth, f_depth, c, telemetry=True)
+# tile lightcones must match those of the whole field, wrapped in x and open in y
+halo = max(p_depth, f_depth)*c
+reference = DiscoReconstructor(p_depth, f_depth, c, distributed=False)
+reference.extract(np.pad(field, ((0,0), (0,0), (halo,halo)), 'wrap'), boundary_condition='open')
+reference_plcs = reference.plcs.reshape(*reference._adjusted_shape, -1)
+recon.extract(myfield, boundary_condition='open')
+tile = driver.tile
+y0, y1 = max(tile.y_start, halo), min(tile.y_stop, Y - halo)
+expected = reference_plcs[slab.start-p_depth : slab.stop-p_depth, y0-halo : y1-halo, tile.x_start : tile.x_stop]
+assert np.array_equal(recon.plcs.reshape(*recon._adjusted_shape, -1), expected), \
+    'rank {} extracted the wrong lightcones'.format(rank)
+
+counts, imbalance = driver.load_imbalance(len(recon.plcs))
+if rank == 0:
+    print('lightcones per rank {} to {}, load imbalance {:.1%}'.format(counts.min(), counts.max(), imbalance))
+recon.kmeans_lightcones({'nClusters':K_past, 'maxIterations':50},
+                        {'nClusters':K_future, 'maxIterations':50},
+                        past_init_params={'nClusters':K_past, 'method':'randomDense', 'distributed':True},
+                        future_init_params={'nClusters':K_future, 'method':'randomDense', 'distributed':True})
+checkpoint_dir = os.path.join(data_dir, 'checkpoint')
+recon.checkpoint(checkpoint_dir, 'cluster', comm)
+recon.reconstruct_morphs()
+recon.reduce_morphs(comm, blocking=False)
+recon.prepare_filter()
+n_signatures = len(map_labels.signatures)
+recon.checkpoint(checkpoint_dir, 'morphs', comm)
+recon.reconstruct_states_ensemble(chi_squared, n_workers=2)
+# every rank runs the same orderings, so keeps the same consensus states
+label_maps = comm.allgather(recon.label_map)
+assert all(np.array_equal(label_maps[0], label_map) for label_map in label_maps)
+recon.checkpoint(checkpoint_dir, 'states', comm)
+recon.causal_filter()
+# the filter runs the kernel prepare_filter() compiled
+assert len(map_labels.signatures) == n_signatures, 'causal_filter() compiled {}'.format(map_labels.signatures)
+
+# a restarted run resumes from the last checkpoint with the same states
+restored = DiscoReconstructor(p_depth, f_depth, c)
+assert restored.restore_checkpoint(checkpoint_dir, comm, n_clusters=(K_past, K_future)) == 'states'
+# but not into a run with another lightcone template or numbers of clusters
+for other, n_clusters in ((DiscoReconstructor(p_depth + 1, f_depth, c), None),
+                          (DiscoReconstructor(p_depth, f_depth, c), (K_past + 1, K_future))):
+    try:
+        other.restore_checkpoint(checkpoint_dir, comm, n_clusters=n_clusters)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('rank {} restored a mismatched checkpoint'.format(rank))
+restored.causal_filter()
+assert np.array_equal(restored.state_field, recon.state_field), 'rank {} restored other states'.format(rank)
+assert np.array_equal(restored.state_stability, recon.state_stability)
+# the non-blocking reduction against a blocking one of the same counts
+comm.Barrier()
+start = MPI.Wtime()
+blocking = recon.joint_counts.allreduce(comm)
+blocking_time = MPI.Wtime() - start
+assert np.array_equal(recon.global_joint_dist, blocking.counts)
+if rank == 0:
+    reduce_times = recon.reduce_times
+    print('blocking reduction {:.4f} s; non-blocking one {} during {:.4f} s of filter preparation, then {:.4f} s waited'.format(
+            blocking_time, 'completed' if reduce_times.completed else 'still in flight',
+            reduce_times.in_flight, reduce_times.waited))
+assert len(recon.state_field) == slab.stop - slab.start
+
+state_field = driver.gather_states(recon.state_field)
+if rank == 0:
+    assert state_field.shape == (T - p_depth - f_depth, Y, X)
+    # only the open y margins are left in the NAN state
+    assert (state_field[:, :halo] == 0).all() and (state_field[:, Y-halo:] == 0).all()
+    assert (state_field[:, halo:Y-halo] > 0).all()
+    print('state field {} with {} states'.format(state_field.shape, len(recon.states)))
+
+# the trained model must give the same states on an untiled decomposition, whose
+# windows wrap around x like the tiles'
+model_file = os.path.join(data_dir, 'model.npz')
+if rank == 0:
+    recon.save(model_file)
+comm.Barrier()
+model = DiscoReconstructor.load(model_file)
+untiled = DiscoDriver(TimeAxis(files, steps_per_file), p_depth, f_depth, comm,
+                      lattice_shape=(Y, X), propagation_speed=c, periodic=(False, True))
+untiled_field = untiled.load(lambda f, start, stop: np.load(os.path.join(data_dir, f))[start:stop])
+untiled_states = model.filter(untiled_field, boundary_condition='open')[:untiled.slab.stop - untiled.slab.start]
+tiled_states = model.filter(myfield, boundary_condition='open')[:slab.stop - slab.start]
+untiled_states = untiled.gather_states(untiled_states)
+tiled_states = driver.gather_states(tiled_states)
+if rank == 0:
+    assert np.array_equal(untiled_states, tiled_states), 'untiled and tiled states differ'
+    assert (untiled_states[:, :, [0, X-1]] > 0)[:, halo:Y-halo].all(), 'x edges left in the NAN state'
+
+states_file = os.path.join(data_dir, 'states.nc')
+driver.write_states(states_file, recon.state_field, dims=('time', 'y', 'x'))
+summary = recon.telemetry_report(comm)
+if rank == 0:
+    assert all(stage in summary for stage in ('extract', 'kmeans_lightcones', 'causal_filter'))
+    print(summary)
+if rank == 0:
+    with Dataset(states_file, 'r') as states:
+        assert np.array_equal(states['states'][:], state_field)
+        assert np.array_equal(states['time'][:], np.arange(p_depth, T - f_depth))
+        assert states.first_step == p_depth
+    shutil.rmtree(data_dir)
+
+d4p.daalfini()
@@ -32,7 +32,8 @@ future_params = {'nClusters':K_future, 'maxIterations':200}
 p_i_params = {'nClusters':K_past, 'method':'randomDense', 'distributed': False}
 f_i_params = {'nClusters':K_future, 'method':'randomDense', 'distributed': False}
 
-model = DiscoReconstructor(p_depth, f_depth, c, distributed=False)
+# n_workers=None: extract lightcones and count the joint distribution on all cores, no MPI needed
+model = DiscoReconstructor(p_depth, f_depth, c, distributed=False, n_workers=None)
 model.extract(turb_field, boundary_condition='periodic')
 model.kmeans_lightcones(past_params, 
                         future_params, 